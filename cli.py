@@ -0,0 +1,214 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+'''
+Command-line interface: fit, score, windows, decode and generate.
+
+Only the standard library is imported at start-up, numpy and the models are imported
+by the subcommands which need them, so short invocations stay cheap.
+'''
+
+# Import required modules
+import logging
+from argparse import ArgumentParser
+
+
+MODEL_CLASSES = {
+    'order0': ('markov_model', 'MarkovOrderZero'),
+    'order1': ('markov_model', 'MarkovOrderOne'),
+    'order2': ('markov_model', 'MarkovOrderTwo'),
+    'hmm': ('hidden_markov_model', 'HiddenMarkovModel'),
+    'context_hmm': ('hidden_markov_model', 'ContextHiddenMarkovModel'),
+}
+
+
+def _model_class(name):
+    '''
+    Import the class of the model called `name` in `MODEL_CLASSES`.
+    '''
+    import importlib
+
+    module_name, class_name = MODEL_CLASSES[name]
+    return getattr(importlib.import_module(module_name), class_name)
+
+
+def _read_input(args):
+    '''
+    Read the (lowercased) input sequence of a subcommand together with its mask index.
+    '''
+    from sequence import MaskIndex, read_fasta
+
+    seq = read_fasta(args.fasta, args.region)
+    mask = MaskIndex.from_sequence(seq, soft_mask=args.soft_mask)
+    return seq.lower(), mask
+
+
+def _region_offset(region):
+    '''
+    Position of the first base of `region` in its record.
+    '''
+    from sequence import parse_region
+
+    _, start, _ = parse_region(region)
+    return start or 0
+
+
+def fit(args):
+    from model_io import save_model
+    from sequence import DNA_VOCAB
+
+    seq, mask = _read_input(args)
+    options = {}
+    if args.model == 'context_hmm':
+        options = {'state_num': args.states, 'order': args.emission_order, 'max_iter': args.max_iter}
+    model = _model_class(args.model)(vocab=DNA_VOCAB, random_seed=args.seed, **options)
+    model.fit(seq, mask, strand_symmetric=args.strand_symmetric)
+    save_model(model, args.output)
+    return
+
+
+def score(args):
+    from model_io import load_model
+
+    model = load_model(args.model)
+    seq, mask = _read_input(args)
+    bases = len(seq) - mask.masked_len()
+    # the vectorized path gives `-inf` to impossible sequences, like `windows` and the scoring server
+    log_prob = float(model.batch_generating_prob([seq], [mask])[0])
+    print('bases\tlog2_prob\tbits_per_base')
+    print(f'{bases}\t{log_prob}\t{log_prob/bases if bases > 0 else float("nan")}')
+    return
+
+
+def windows(args):
+    import numpy as np
+    from markov_model import sum_log_probs
+    from model_io import load_model
+
+    if args.window < 1 or args.step < 1:
+        raise ValueError('Window and step sizes must be positive.')
+
+    model = load_model(args.model)
+    seq, mask = _read_input(args)
+    log_probs = model.position_log_probs(seq, mask)
+
+    starts = np.arange(0, max(len(seq)-args.window, 0)+1, args.step)
+    ends = np.minimum(starts + args.window, len(seq))
+    window_log_probs, bases = sum_log_probs(log_probs, starts, ends)
+
+    offset = _region_offset(args.region)
+    lines = ['start\tend\tbases\tlog2_prob\tbits_per_base']
+    with np.errstate(invalid='ignore', divide='ignore'):
+        bits_per_base = window_log_probs / bases
+    for start, end, base_num, log_prob, bits in zip(
+            (starts+offset).tolist(), (ends+offset).tolist(), bases.tolist(), window_log_probs.tolist(), bits_per_base.tolist()):
+        lines.append(f'{start}\t{end}\t{base_num}\t{log_prob}\t{bits}')
+    print('\n'.join(lines))
+    return
+
+
+def decode(args):
+    from model_io import load_model
+
+    model = load_model(args.model)
+    if not hasattr(model, 'state_sequence'):
+        raise TypeError(f'{args.model} is not a hidden Markov model.')
+
+    seq, mask = _read_input(args)
+    state_path = ''.join(model.state_sequence(seq, mask))
+    if args.output is None:
+        print(state_path)
+    else:
+        with open(args.output, 'w') as f:
+            f.write(state_path + '\n')
+    return
+
+
+def generate(args):
+    from model_io import load_model
+
+    model = load_model(args.model)
+    if args.seed is not None:
+        import numpy as np
+
+        model.random_seed = args.seed
+        model.seed_sequence = np.random.SeedSequence(args.seed)
+        model.rng = np.random.default_rng(model.seed_sequence)
+
+    seq_len = model.generate_to_file(args.output, args.length, chunk_size=args.chunk_size,
+            fmt=args.format, name=args.name, line_width=args.line_width)
+    logging.info(f'Generated {seq_len} bases into {args.output}')
+    return
+
+
+def _add_input_arguments(parser):
+    parser.add_argument('fasta', help='FASTA file (or plain sequence file).')
+    parser.add_argument('-r', '--region', help='Region to use, e.g. `NC_000006.12:100001-200000`.')
+    parser.add_argument('-s', '--soft-mask', help='Whether to skip soft-masked (lowercase) repeats as well as N gaps.', action='store_true')
+
+
+def build_parser():
+    parser = ArgumentParser(description='Fit, score, decode and sample Markov and hidden Markov models of DNA.')
+    parser.add_argument('-p', '--print-detail', help='Whether to print details.', action='store_true')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    fit_parser = subparsers.add_parser('fit', help='Fit a model and save it.')
+    _add_input_arguments(fit_parser)
+    fit_parser.add_argument('-m', '--model', help='Model to fit.', choices=MODEL_CLASSES.keys(), default='order2')
+    fit_parser.add_argument('-o', '--output', help='Path of the saved model.', required=True)
+    fit_parser.add_argument('--strand-symmetric', help='Count the k-mers of both strands.', action='store_true')
+    fit_parser.add_argument('--seed', help='Random seed of the model.', type=int, default=17)
+    fit_parser.add_argument('--states', help='Number of states of `context_hmm`.', type=int, default=2)
+    fit_parser.add_argument('--emission-order', help='Markov order of the emissions of `context_hmm`.', type=int, default=1)
+    fit_parser.add_argument('--max-iter', help='Maximum number of Baum-Welch iterations of `context_hmm`.', type=int, default=20)
+    fit_parser.set_defaults(handler=fit)
+
+    score_parser = subparsers.add_parser('score', help='Score a sequence with a saved model.')
+    score_parser.add_argument('model', help='Path of the saved model.')
+    _add_input_arguments(score_parser)
+    score_parser.set_defaults(handler=score)
+
+    windows_parser = subparsers.add_parser('windows', help='Score sliding windows of a sequence with a saved model.')
+    windows_parser.add_argument('model', help='Path of the saved model.')
+    _add_input_arguments(windows_parser)
+    windows_parser.add_argument('-w', '--window', help='Window size.', type=int, default=1000)
+    windows_parser.add_argument('--step', help='Distance between window starts.', type=int, default=1000)
+    windows_parser.set_defaults(handler=windows)
+
+    decode_parser = subparsers.add_parser('decode', help='Decode the most likely state sequence with a saved HMM.')
+    decode_parser.add_argument('model', help='Path of the saved model.')
+    _add_input_arguments(decode_parser)
+    decode_parser.add_argument('-o', '--output', help='File to write the state sequence to (default: stdout).')
+    decode_parser.set_defaults(handler=decode)
+
+    generate_parser = subparsers.add_parser('generate', help='Generate a sequence with a saved model.')
+    generate_parser.add_argument('model', help='Path of the saved model.')
+    generate_parser.add_argument('length', help='Length of the generated sequence.', type=int)
+    generate_parser.add_argument('-o', '--output', help='Output file.', required=True)
+    generate_parser.add_argument('-f', '--format', help='Output format.', choices=['fasta', '2bit'], default='fasta')
+    generate_parser.add_argument('--name', help='Name of the generated record.', default='generated')
+    generate_parser.add_argument('--chunk-size', help='Number of bases generated at a time.', type=int, default=1000000)
+    generate_parser.add_argument('--line-width', help='Width of the FASTA lines.', type=int, default=60)
+    generate_parser.add_argument('--seed', help='Random seed overriding the one of the model.', type=int)
+    generate_parser.set_defaults(handler=generate)
+
+    return parser
+
+
+def main():
+    parser = build_parser()
+    args = parser.parse_args()
+
+    if args.print_detail:
+        logging.basicConfig(level=logging.INFO,
+                format='\n%(asctime)s %(name)-5s === %(levelname)-5s === %(message)s\n')
+
+    try:
+        args.handler(args)
+    except (OSError, TypeError, ValueError, UnboundLocalError) as e:
+        parser.exit(1, f'{parser.prog}: error: {e}\n')
+
+    return
+
+
+if __name__ == '__main__':
+    main()
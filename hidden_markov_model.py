@@ -1,14 +1,141 @@
-from nltk import trigrams
-from markov_model import MarkovBase
+from markov_model import _SCAN_CELLS, _SCAN_CHUNK, MarkovBase, _compose_scan, _draw_chain, sum_log_probs
+from sequence import INVALID, encode, kmer_ids
 import numpy as np
-from tqdm import tqdm
 
+import copy
+import itertools
 import logging
-import random
 import re
 import math
 
-class HiddenMarkovModel(MarkovBase):
+
+def _log_matmul(a, b):
+    '''
+    Multiply the stacked (log base 2) matrices `a` and `b` in the sum-product semiring.
+    The sums run over the (few) states one at a time, rescaled by their maximum, so long products don't underflow.
+    '''
+    terms = [ a[..., :, k, None] + b[..., None, k, :] for k in range(a.shape[-1]) ]
+    top = terms[0]
+    for term in terms[1:]:
+        top = np.maximum(top, term)
+    top = np.where(np.isfinite(top), top, 0)
+    total = np.exp2(terms[0] - top)
+    for term in terms[1:]:
+        total += np.exp2(term - top)
+    with np.errstate(divide='ignore'):
+        return np.log2(total) + top
+
+
+def _max_plus(a, b):
+    '''
+    Multiply the stacked (log base 2) matrices `a` and `b` in the max-plus semiring.
+    '''
+    product = a[..., :, 0, None] + b[..., None, 0, :]
+    for k in range(1, a.shape[-1]):
+        product = np.maximum(product, a[..., :, k, None] + b[..., None, k, :])
+    return product
+
+
+def _prefix_scan(mats, combine):
+    '''
+    Inclusive prefix products `mats[0] * ... * mats[i]` of the stacked matrices `mats` under the associative `combine`,
+    calculated in log2(N) array steps by doubling.
+    '''
+    step = 1
+    while step < len(mats):
+        mats = np.concatenate((mats[:step], combine(mats[:-step], mats[step:])))
+        step *= 2
+    return mats
+
+
+def _scan_vector(carry, log_trans, log_emit, combine, emit_axis=1, out=None):
+    '''
+    Propagate the (log base 2) state vector `carry` through the step matrices `log_trans` + `log_emit[i]`,
+    the emissions being added to the columns (`emit_axis=1`) or to the rows (`emit_axis=2`).
+    Return the state vector after every step, written into `out` if given.
+    Every block is cut into chunks of `_SCAN_CHUNK` steps: the step matrices are multiplied chunk-wise in parallel,
+    the chunk products are prefix-scanned by doubling, and the vector entering every chunk is finally
+    propagated through its steps, again for all chunks at once.
+    '''
+    state_num = len(carry)
+    block_size = max(_SCAN_CHUNK, _SCAN_CELLS // state_num**2)
+    vectors = np.empty((len(log_emit), state_num)) if out is None else out
+    for start in range(0, len(log_emit), block_size):
+        end = min(start+block_size, len(log_emit))
+        chunk_len = min(_SCAN_CHUNK, end-start)
+        chunk_num = -(-(end-start) // chunk_len)
+        # pad the last chunk, its extra steps only follow the returned vectors
+        chunk_emit = np.zeros((chunk_num*chunk_len, state_num))
+        chunk_emit[:end-start] = log_emit[start:end]
+        chunk_emit = chunk_emit.reshape(chunk_num, chunk_len, state_num)
+
+        chunk_mats = log_trans[None] + np.expand_dims(chunk_emit[:, 0], emit_axis)
+        for step in range(1, chunk_len):
+            chunk_mats = combine(chunk_mats, log_trans[None] + np.expand_dims(chunk_emit[:, step], emit_axis))
+
+        chunk_vectors = np.empty((chunk_num, state_num))
+        chunk_vectors[0] = carry
+        chunk_vectors[1:] = combine(carry[None, None, :], _prefix_scan(chunk_mats[:-1], combine))[:, 0]
+
+        block_vectors = np.empty((chunk_num, chunk_len, state_num))
+        for step in range(chunk_len):
+            chunk_vectors = combine(
+                chunk_vectors[:, None, :], log_trans[None] + np.expand_dims(chunk_emit[:, step], emit_axis)
+            )[:, 0]
+            block_vectors[:, step] = chunk_vectors
+        vectors[start:end] = block_vectors.reshape(-1, state_num)[:end-start]
+        carry = vectors[end-1]
+    return vectors
+
+
+def _sample_states(rng, init_state_prob, state_change_prob, seq_len, last_state=None):
+    '''
+    Draw a state chain of `seq_len` states, continuing from `last_state` (or from the initial states).
+    The chain is drawn from one block of uniform numbers: every draw is turned into a
+    "next state of each state" map, and the maps are followed from the first state by `_compose_scan`.
+    '''
+    state_num = len(init_state_prob)
+    random_nums = rng.random(seq_len)
+    first_state_prob = init_state_prob if last_state is None else state_change_prob[last_state]
+    first_state = min(np.searchsorted(np.cumsum(first_state_prob), random_nums[0], side='right'), state_num-1)
+    change_threshold = np.cumsum(state_change_prob, axis=1)
+    next_states = (random_nums[1:, None, None] >= change_threshold[None, :, :]).sum(axis=2)
+    next_states = np.minimum(next_states, state_num-1)
+    states = np.empty(seq_len, dtype=np.intp)
+    states[0] = first_state
+    states[1:] = _compose_scan(next_states, first_state)
+    return states
+
+
+def _normalize(counts, axis=-1):
+    '''
+    Normalize `counts` into probabilities along `axis`, all-zero rows become uniform.
+    '''
+    sums = counts.sum(axis=axis, keepdims=True)
+    return np.where(sums > 0, counts / np.where(sums > 0, sums, 1), 1/counts.shape[axis])
+
+
+class HiddenMarkovBase(MarkovBase):
+    '''
+    Behaviour shared by the hidden Markov models: sequences are generated through `sample`,
+    and there are no local context windows since the hidden states carry information along the whole sequence.
+    '''
+    def generate(self, seq_len):
+        '''
+        Generate a sequence with the fitted state change and emission probabilities.
+        '''
+        seq, _ = self.sample(seq_len)
+        return seq
+
+
+    def score_variants(self, reference, variants, ref_log_probs=None):
+        '''
+        Not supported: there is no local context window to rescore.
+        '''
+        raise TypeError(f'{type(self).__name__} has no local context window to rescore.')
+
+
+class HiddenMarkovModel(HiddenMarkovBase):
     def __init__(self, vocab, random_seed):
         super().__init__(vocab, random_seed)
 
@@ -44,6 +171,8 @@ class HiddenMarkovModel(MarkovBase):
             'h': 0,
             'l': 1,
         }
+        # placeholder of the masked positions in decoded state sequences
+        self.masked_state = '-'
 
         # decide the prob of deciding the first char of sequences: equal distribution
         self.first_choice_prob = {}
@@ -57,7 +186,7 @@ class HiddenMarkovModel(MarkovBase):
         '''
         Convert the number of counts in `self.cond_prob` into probabilities which should sum to 1.
         '''
-        self.cond_prob = self.counts.copy()
+        self.cond_prob = copy.deepcopy(self.counts)
         for char in self.counts.keys():
             occur_count = 0
             for target in self.counts[char].keys():
@@ -125,28 +254,16 @@ class HiddenMarkovModel(MarkovBase):
         return
 
 
-    def get_state_change(self, seq):
+    def get_state_change(self, seq, mask=None, strand_symmetric=False):
         '''
-        get the trigram of sequences to calculate the   
+        get the trigram of sequences to calculate the state change probabilities.
+        Trigrams never cross the boundaries of the intervals masked by `mask`.
         '''
-        seq_trigrams = list(trigrams(seq))
-
-        # construct `counts`: the dimension should be 4x4x4
-        base_permutations = []
-        for char_first in self.vocab:
-            for char_second in self.vocab:
-                for char_target in self.vocab:
-                    base_permutations.append((char_first, char_second, char_target))
-
-        for p in base_permutations:
-            if p not in seq_trigrams:
-                self.state_count[p] = 0
-                continue
-            for s in seq_trigrams:
-                if p == s and p not in self.state_count.keys():
-                    self.state_count[p] = 1
-                elif p == s and p in self.state_count.keys():
-                    self.state_count[p] += 1
+        # construct `state_count`: the dimension should be 4x4x4
+        trigram_counts = self._count_kmers(seq, mask, 3, strand_symmetric)
+        base_permutations = itertools.product(self.vocab, repeat=3)
+        for p, count in zip(base_permutations, trigram_counts.tolist()):
+            self.state_count[p] = count
         
         for trigram, count in self.state_count.items():
             if count > 0:
@@ -165,9 +282,11 @@ class HiddenMarkovModel(MarkovBase):
         return
 
 
-    def fit(self, seq):
+    def fit(self, seq, mask=None, strand_symmetric=False):
         '''
         Calculate subsequence occurrences and convert it into conditional probabilities.
+        The intervals covered by `mask` (a `MaskIndex`) are skipped.
+        With `strand_symmetric` the reverse complement strand is counted as well.
         '''
         if not isinstance(seq, str):
             raise TypeError('Invalid parameter `seq`.')
@@ -175,28 +294,22 @@ class HiddenMarkovModel(MarkovBase):
         if len(seq) < self.order+1:
             raise ValueError('Invalid parameter `seq`.')
 
-        seq_len = len(seq)
-        pair_num = seq_len - self.order
-
-        for index, char in enumerate(seq):
-            if index < pair_num:
-                self.counts[char][seq[index+1]] += 1
+        self._add_counts(self._count_kmers(seq, mask, self.order+1, strand_symmetric))
         
         self._to_cond_prob()
         self.get_state_prob()
         logging.info(f'State_Prob: {self.state_prob}')
         logging.info(f'Init_State_Prob: {self.init_state_prob}')
-        self.get_state_change(seq)
+        self.get_state_change(seq, mask, strand_symmetric)
         logging.info(f'State_Change_Prob: {self.state_change_prob}')
         return
 
 
-    def generating_prob(self, seq):
+    def _state_arrays(self):
         '''
-        Calculate the (log base 2) probabilitiy of generating a given sequence.
+        Convert the initial state, state change and emission probabilities into numpy arrays.
         '''
-        # convert dict to numpy array
-        cur_state_prob = np.array(list(v for k, v in self.init_state_prob.items()))
+        init_state_prob = np.array([ self.init_state_prob[state] for state in self.state2id.keys() ])
         state_change_prob = np.array(
             [
                 [ self.state_change_prob[state_start][state_end] for state_end in self.state2id.keys() ]
@@ -205,21 +318,156 @@ class HiddenMarkovModel(MarkovBase):
         )
         output_prob = np.array(
             [ 
-                [ self.state_prob[state][char] for char in self.vocab ] 
+                [ self.state_prob[state].get(char, 0) for char in self.vocab ] 
                     for state in self.state2id.keys()
             ]
         )
+        return init_state_prob, state_change_prob, output_prob
+
+
+    def sample(self, seq_len):
+        '''
+        Generate a sequence together with the state path which emitted it.
+        '''
+        if self.cond_prob == None:
+            raise UnboundLocalError('Model hasn\'t been fitted yet.')
+
+        if not isinstance(seq_len, int):
+            raise TypeError('Invalid parameter `seq_len`.')
+
+        if seq_len < 1:
+            raise ValueError('Invalid parameter `seq_len`.')
+
+        seq, states = self._sample(seq_len)
+        state_chars = np.frombuffer(''.join(self.id2state[index] for index in range(len(self.id2state))).encode(), dtype=np.uint8)
+        return seq, state_chars[states].tobytes().decode()
+
+
+    def _sample(self, seq_len, last_state=None):
+        '''
+        Generate a sequence and its state ids, continuing from `last_state` (or from the initial states).
+        The state chain is drawn by `_sample_states`, the emissions are then drawn in bulk for all positions of each state.
+        '''
+        init_state_prob, state_change_prob, output_prob = self._state_arrays()
+        state_num = len(init_state_prob)
+        states = _sample_states(self.rng, init_state_prob, state_change_prob, seq_len, last_state)
+
+        # draw the emissions of every state in bulk
+        random_nums = self.rng.random(seq_len)
+        codes = np.empty(seq_len, dtype=np.uint8)
+        for state in range(state_num):
+            positions = states == state
+            output_threshold = np.cumsum(output_prob[state])
+            codes[positions] = np.minimum(
+                np.searchsorted(output_threshold, random_nums[positions], side='right'), self.vocab_size-1
+            )
+
+        vocab_chars = np.frombuffer(''.join(self.vocab).encode(), dtype=np.uint8)
+        return vocab_chars[codes].tobytes().decode(), states
+
+
+    def _iter_chunks(self, total_len, chunk_size):
+        '''
+        Yield the chunks of `generate_chunks`, carrying the last state between the chunks.
+        '''
+        if self.cond_prob == None:
+            raise UnboundLocalError('Model hasn\'t been fitted yet.')
+
+        last_state = None
+        for start in range(0, total_len, chunk_size):
+            seq, states = self._sample(min(chunk_size, total_len-start), last_state)
+            last_state = states[-1]
+            yield seq
+
+
+    def generating_prob(self, seq, mask=None):
+        '''
+        Calculate the (log base 2) probabilitiy of generating a given sequence.
+        The intervals covered by `mask` (a `MaskIndex`) are skipped, every unmasked interval restarts from the initial states.
+        '''
+        init_state_prob, state_change_prob, output_prob = self._state_arrays()
         cur_prob = 0
-        for char in seq:
-            cur_state_prob = np.dot(cur_state_prob, state_change_prob)
-            cur_output_prob = np.dot(cur_state_prob, output_prob)
-            cur_prob += math.log(cur_output_prob[self.vocab2id[char]], 2)
+        for start, end in self._segments(seq, mask):
+            cur_state_prob = init_state_prob
+            for char in seq[start:end]:
+                cur_state_prob = np.dot(cur_state_prob, state_change_prob)
+                cur_output_prob = np.dot(cur_state_prob, output_prob)
+                cur_prob += math.log(cur_output_prob[self.vocab2id[char]], 2)
         return cur_prob
 
 
-    def state_sequence(self, seq):
+    def _log_output_table(self, seq_len):
+        '''
+        Calculate the (log base 2) emission probabilities of the first `seq_len` positions of an interval,
+        as iterated from the initial states by `generating_prob`, with an extra `nan` column for characters outside of the vocabulary.
+        The state distribution converges after a few positions, so it is only iterated until it stops changing:
+        position i of an interval uses the row `min(i, len(table)-1)`.
+        '''
+        init_state_prob, state_change_prob, output_prob = self._state_arrays()
+        cur_state_prob = init_state_prob
+        output_probs = []
+        while len(output_probs) < max(seq_len, 1):
+            next_state_prob = np.dot(cur_state_prob, state_change_prob)
+            output_probs.append(np.dot(next_state_prob, output_prob))
+            if np.array_equal(next_state_prob, cur_state_prob):
+                break
+            cur_state_prob = next_state_prob
+        with np.errstate(divide='ignore'):
+            log_outputs = np.log2(output_probs)
+        return np.concatenate((log_outputs, np.full((len(log_outputs), 1), np.nan)), axis=1)
+
+
+    def position_log_probs(self, seq, mask=None):
+        '''
+        Calculate the (log base 2) probability of every position of `seq`, as summed up by `generating_prob`.
+        Masked positions and characters outside of the vocabulary are `nan`.
+        '''
+        if not isinstance(seq, str):
+            raise TypeError('Invalid parameter `seq`.')
+
+        segments = self._segments(seq, mask)
+        log_outputs = self._log_output_table(max([ end-start for start, end in segments ], default=0))
+        codes = np.minimum(encode(seq, self.vocab2id), self.vocab_size)
+        log_probs = np.full(len(seq), np.nan)
+        for start, end in segments:
+            rows = np.minimum(np.arange(end-start), len(log_outputs)-1)
+            log_probs[start:end] = log_outputs[rows, codes[start:end]]
+        return log_probs
+
+
+    def batch_generating_prob(self, seqs, masks=None):
+        '''
+        Calculate the (log base 2) probability of generating every sequence of `seqs` in one vectorized pass,
+        skipping `masks` (a `MaskIndex` or `None` for every sequence) like `generating_prob`.
+        Characters outside of the vocabulary are skipped, sequences which can't be generated get `-inf`.
+        '''
+        codes, starts, ends, positions, segment_offsets = self._batch_positions(seqs, masks)
+        log_outputs = self._log_output_table(int(segment_offsets.max())+1 if len(segment_offsets) > 0 else 0)
+        log_probs = np.full(len(codes), np.nan)
+        rows = np.minimum(segment_offsets, len(log_outputs)-1)
+        log_probs[positions] = log_outputs[rows, np.minimum(codes[positions], self.vocab_size)]
+        log_prob_sums, _ = sum_log_probs(log_probs, starts, ends)
+        return log_prob_sums
+
+
+    def state_sequence(self, seq, mask=None):
         '''
         Use Viterbi algorithm to calculate the most likely state sequence for emitting the given sequence `seq`.
+        Every unmasked interval of `mask` is decoded on its own, masked positions get `self.masked_state`.
+        '''
+        state_path = []
+        last_end = 0
+        for start, end in self._segments(seq, mask):
+            state_path += [self.masked_state] * (start-last_end)
+            state_path += self._viterbi(seq[start:end])
+            last_end = end
+        state_path += [self.masked_state] * (len(seq)-last_end)
+        return state_path
+
+
+    def _viterbi(self, seq):
+        '''
+        Calculate the most likely state sequence for emitting the (unmasked) sequence `seq`.
         '''
         # initialize
         v = [{}]
@@ -229,7 +477,7 @@ class HiddenMarkovModel(MarkovBase):
             path[state] = [state]
 
         # calculate the most likely path in each timestamp
-        for index, char in tqdm(enumerate(seq)):
+        for index, char in enumerate(seq):
             if index > 0:
                 v.append({})
                 newpath = {}
@@ -249,6 +497,377 @@ class HiddenMarkovModel(MarkovBase):
         return most_likely_path
 
 
+class ContextHiddenMarkovModel(HiddenMarkovBase):
+    '''
+    Hidden Markov model whose states emit with their own order-`order` Markov chains.
+    The emission probabilities form a (state, context id, base) tensor, so every state can capture
+    dinucleotide (or longer) signals such as the CpG depletion outside of CpG islands.
+    Forward, Viterbi and the Baum-Welch fitting run as blocked prefix scans of the step matrices
+    in the sum-product and max-plus semirings, vectorized over the whole sequence.
+    '''
+    def __init__(self, vocab, random_seed, state_num=2, order=1, max_iter=20, tol=1e-6, pseudocount=1.0):
+        super().__init__(vocab, random_seed)
+
+        if not isinstance(state_num, int):
+            raise TypeError('Invalid parameter `state_num`.')
+
+        if not isinstance(order, int):
+            raise TypeError('Invalid parameter `order`.')
+
+        if not isinstance(max_iter, int):
+            raise TypeError('Invalid parameter `max_iter`.')
+
+        if state_num < 1 or state_num > 10:
+            raise ValueError('Invalid parameter `state_num`.')
+
+        if order < 0:
+            raise ValueError('Invalid parameter `order`.')
+
+        if max_iter < 1:
+            raise ValueError('Invalid parameter `max_iter`.')
+
+        if pseudocount < 0:
+            raise ValueError('Invalid parameter `pseudocount`.')
+
+        self.order = order
+        self.state_num = state_num
+        self.context_num = self.vocab_size**self.order
+        self.max_iter = max_iter
+        self.tol = tol
+        self.pseudocount = pseudocount
+
+        self.id2state = {index: str(index) for index in range(self.state_num)}
+        self.state2id = {state: index for index, state in self.id2state.items()}
+        # placeholder of the masked positions in decoded state sequences
+        self.masked_state = '-'
+
+        # `emission_prob[state][context id][base]`
+        self.init_state_prob = None
+        self.state_change_prob = None
+        self.emission_prob = None
+        # (log base 2) probability of the training sequence after every iteration of `fit`
+        self.fit_history = []
+
+        # conditional probabilities of the order-`order` Markov chain pooled over the states
+        self.cond_prob = None
+        return
+
+
+    def _to_nested(self, flat_values):
+        '''
+        Convert flat values, indexed by (order+1)-mer id, into nested dictionaries like `self.cond_prob`.
+        '''
+        nested = {}
+        for kmer, value in zip(itertools.product(self.vocab, repeat=self.order+1), flat_values.tolist()):
+            node = nested
+            for char in kmer[:-1]:
+                node = node.setdefault(char, {})
+            node[kmer[-1]] = value
+        return nested
+
+
+    def _encoded_segments(self, seq, mask, strand_symmetric=False):
+        '''
+        Encode the unmasked intervals of `seq`, followed by their reverse complements if `strand_symmetric`.
+        '''
+        codes = encode(seq, self.vocab2id)
+        segments = [ codes[start:end] for start, end in self._segments(seq, mask) if end > start ]
+        if strand_symmetric:
+            segments += [
+                np.where(segment == INVALID, INVALID, self.vocab_size-1-segment).astype(np.uint8)[::-1]
+                    for segment in segments
+            ]
+        return segments
+
+
+    def _log_arrays(self):
+        '''
+        Return the (log base 2) initial state, state change, flat emission (state, (order+1)-mer id)
+        and first choice probabilities.
+        '''
+        if self.cond_prob == None:
+            raise UnboundLocalError('Model hasn\'t been fitted yet.')
+
+        with np.errstate(divide='ignore'):
+            return (
+                np.log2(self.init_state_prob),
+                np.log2(self.state_change_prob),
+                np.log2(self.emission_prob.reshape(self.state_num, -1)),
+                np.log2([ self.first_choice_prob[char] for char in self.vocab ]),
+            )
+
+
+    def _log_emissions(self, codes, log_emission, log_first_choice):
+        '''
+        Gather the (log base 2) emission probability of every position of `codes` in every state, shape (N, state_num).
+        Positions without a full context use the first choice probabilities, characters outside of the vocabulary emit with probability 1.
+        Return them together with the (order+1)-mer ids and their validity.
+        '''
+        log_emit = np.zeros((len(codes), self.state_num))
+        valid_base = codes != INVALID
+        log_emit[valid_base] = log_first_choice[codes[valid_base]][:, None]
+        ids, valid = kmer_ids(codes, self.order+1, self.vocab_size)
+        log_emit[self.order:][valid] = log_emission.T[ids[valid]]
+        return log_emit, ids, valid
+
+
+    def _forward(self, log_emit, log_init, log_trans):
+        '''
+        Calculate the (log base 2) forward variables of one segment with a sum-product prefix scan.
+        '''
+        alpha = np.empty_like(log_emit)
+        alpha[0] = log_init + log_emit[0]
+        _scan_vector(alpha[0], log_trans, log_emit[1:], _log_matmul, out=alpha[1:])
+        return alpha
+
+
+    def _backward(self, log_emit, log_trans):
+        '''
+        Calculate the (log base 2) backward variables of one segment, scanning the transposed step matrices from the end.
+        '''
+        beta = np.zeros_like(log_emit)
+        _scan_vector(beta[-1], log_trans.T, log_emit[:0:-1], _log_matmul, emit_axis=2, out=beta[-2::-1])
+        return beta
+
+
+    def fit(self, seq, mask=None, strand_symmetric=False):
+        '''
+        Fit the model with the Baum-Welch algorithm.
+        The states start from random perturbations of the pooled order-`order` conditional probabilities with sticky state changes,
+        and are refined until the log probability improves by less than `tol` bits per base or `max_iter` iterations.
+        The intervals covered by `mask` (a `MaskIndex`) are skipped.
+        With `strand_symmetric` the reverse complement strand is fitted as well.
+        '''
+        if not isinstance(seq, str):
+            raise TypeError('Invalid parameter `seq`.')
+
+        if len(seq) < self.order+1:
+            raise ValueError('Invalid parameter `seq`.')
+
+        kmer_num = self.context_num * self.vocab_size
+        pooled_counts = self._count_kmers(seq, mask, self.order+1, strand_symmetric)
+        self.cond_prob = self._to_nested(_normalize(pooled_counts.reshape(-1, self.vocab_size)).ravel())
+        segments = self._encoded_segments(seq, mask, strand_symmetric)
+        base_num = sum(int(np.sum(segment != INVALID)) for segment in segments)
+
+        # initialize
+        pooled_prob = _normalize(pooled_counts.reshape(-1, self.vocab_size) + self.pseudocount)
+        emission_prob = self.rng.gamma(50 * np.broadcast_to(pooled_prob, (self.state_num,) + pooled_prob.shape))
+        self.emission_prob = _normalize(emission_prob)
+        self.init_state_prob = np.full(self.state_num, 1/self.state_num)
+        self.state_change_prob = np.full((self.state_num, self.state_num), 0.01/max(self.state_num-1, 1))
+        np.fill_diagonal(self.state_change_prob, 0.99 if self.state_num > 1 else 1)
+
+        self.fit_history = []
+        for iteration in range(self.max_iter):
+            log_init, log_trans, log_emission, log_first_choice = self._log_arrays()
+            init_counts = np.zeros(self.state_num)
+            change_counts = np.zeros((self.state_num, self.state_num))
+            emission_counts = np.zeros((self.state_num, kmer_num))
+            log_prob = 0
+            for codes in segments:
+                log_emit, ids, valid = self._log_emissions(codes, log_emission, log_first_choice)
+                alpha = self._forward(log_emit, log_init, log_trans)
+                beta = self._backward(log_emit, log_trans)
+                segment_log_prob = np.logaddexp2.reduce(alpha[-1])
+                log_prob += segment_log_prob
+
+                # expected state occupancies, state changes and emissions, in blocks of positions
+                init_counts += np.exp2(alpha[0] + beta[0] - segment_log_prob)
+                block_size = max(1, _SCAN_CELLS // self.state_num**2)
+                for start in range(0, len(codes), block_size):
+                    end = min(start+block_size, len(codes))
+                    change_start = max(start, 1)
+                    change_counts += np.exp2(
+                        alpha[change_start-1:end-1, :, None] + log_trans[None]
+                            + (log_emit[change_start:end] + beta[change_start:end])[:, None, :] - segment_log_prob
+                    ).sum(axis=0)
+
+                    # the (order+1)-mers ending in the block
+                    kmer_start = max(start, self.order)
+                    posterior = np.exp2(alpha[kmer_start:end] + beta[kmer_start:end] - segment_log_prob)
+                    block_ids = ids[kmer_start-self.order:end-self.order]
+                    block_valid = valid[kmer_start-self.order:end-self.order]
+                    for state in range(self.state_num):
+                        emission_counts[state] += np.bincount(
+                            block_ids[block_valid], weights=posterior[:, state][block_valid], minlength=kmer_num
+                        )
+
+            self.fit_history.append(float(log_prob))
+            logging.info(f'Iteration {iteration}: log probability {log_prob}')
+
+            self.init_state_prob = _normalize(init_counts)
+            self.state_change_prob = _normalize(change_counts)
+            self.emission_prob = _normalize(
+                emission_counts.reshape(self.state_num, self.context_num, self.vocab_size) + self.pseudocount
+            )
+            if iteration > 0 and self.fit_history[-1] - self.fit_history[-2] < self.tol * base_num:
+                break
+
+        logging.info(f'Init_State_Prob: {self.init_state_prob}')
+        logging.info(f'State_Change_Prob: {self.state_change_prob}')
+        return
+
+
+    def sample(self, seq_len):
+        '''
+        Generate a sequence together with the state path which emitted it.
+        '''
+        if self.cond_prob == None:
+            raise UnboundLocalError('Model hasn\'t been fitted yet.')
+
+        if not isinstance(seq_len, int):
+            raise TypeError('Invalid parameter `seq_len`.')
+
+        if seq_len < 1:
+            raise ValueError('Invalid parameter `seq_len`.')
+
+        seq, states, _ = self._sample(seq_len)
+        return seq, ''.join(self.id2state[state] for state in states.tolist())
+
+
+    def _sample(self, seq_len, last_state=None, context=None):
+        '''
+        Generate a sequence and its state ids, continuing from `last_state` and the codes `context` of the last bases.
+        Given the states, every draw is turned into a "next context of each context" map,
+        and the maps are prefix-composed in blocks like the state chain.
+        Return the sequence, the state ids and the codes of the last `order` bases.
+        '''
+        states = _sample_states(self.rng, self.init_state_prob, self.state_change_prob, seq_len, last_state)
+        context = np.zeros(0, dtype=np.uint8) if context is None else context
+
+        # positions without a full context use the first choice probabilities
+        codes = np.empty(seq_len, dtype=np.uint8)
+        head = min(max(self.order-len(context), 0), seq_len)
+        codes[:head] = np.minimum((self.rng.random(head) * self.vocab_size).astype(np.uint8), self.vocab_size-1)
+        history = np.concatenate((context, codes[:head]))[max(len(context)+head-self.order, 0):]
+
+        context_id = 0
+        for code in history.tolist():
+            context_id = context_id*self.vocab_size + code
+        emission_threshold = np.cumsum(self.emission_prob, axis=2)
+        block_size = max(1, _SCAN_CELLS // (self.context_num*self.vocab_size))
+        for start in range(head, seq_len, block_size):
+            end = min(start+block_size, seq_len)
+            codes[start:end], _, context_id = _draw_chain(
+                self.rng.random(end-start), emission_threshold[states[start:end]], context_id, self.vocab_size
+            )
+
+        context = np.concatenate((context, codes))[max(len(context)+seq_len-self.order, 0):]
+        vocab_chars = np.frombuffer(''.join(self.vocab).encode(), dtype=np.uint8)
+        return vocab_chars[codes].tobytes().decode(), states, context
+
+
+    def _iter_chunks(self, total_len, chunk_size):
+        '''
+        Yield the chunks of `generate_chunks`, carrying the last state and context between the chunks.
+        '''
+        if self.cond_prob == None:
+            raise UnboundLocalError('Model hasn\'t been fitted yet.')
+
+        last_state = None
+        context = None
+        for start in range(0, total_len, chunk_size):
+            seq, states, context = self._sample(min(chunk_size, total_len-start), last_state, context)
+            last_state = states[-1]
+            yield seq
+
+
+    def generating_prob(self, seq, mask=None):
+        '''
+        Calculate the (log base 2) probabilitiy of generating a given sequence with the forward algorithm.
+        The intervals covered by `mask` (a `MaskIndex`) are skipped, every unmasked interval restarts from the initial states.
+        '''
+        if not isinstance(seq, str):
+            raise TypeError('Invalid parameter `seq`.')
+
+        log_init, log_trans, log_emission, log_first_choice = self._log_arrays()
+        cur_prob = 0
+        for codes in self._encoded_segments(seq, mask):
+            log_emit, _, _ = self._log_emissions(codes, log_emission, log_first_choice)
+            cur_prob += np.logaddexp2.reduce(self._forward(log_emit, log_init, log_trans)[-1])
+        return float(cur_prob)
+
+
+    def position_log_probs(self, seq, mask=None):
+        '''
+        Calculate the (log base 2) probability of every position of `seq` given the previous positions of its interval,
+        the differences of the forward log probabilities.
+        Masked positions and characters outside of the vocabulary are `nan`.
+        '''
+        if not isinstance(seq, str):
+            raise TypeError('Invalid parameter `seq`.')
+
+        log_init, log_trans, log_emission, log_first_choice = self._log_arrays()
+        codes = encode(seq, self.vocab2id)
+        log_probs = np.full(len(seq), np.nan)
+        for start, end in self._segments(seq, mask):
+            if end == start:
+                continue
+            log_emit, _, _ = self._log_emissions(codes[start:end], log_emission, log_first_choice)
+            prefix_log_probs = np.logaddexp2.reduce(self._forward(log_emit, log_init, log_trans), axis=1)
+            segment_log_probs = np.diff(prefix_log_probs, prepend=0)
+            log_probs[start:end] = np.where(codes[start:end] != INVALID, segment_log_probs, np.nan)
+        return log_probs
+
+
+    def batch_generating_prob(self, seqs, masks=None):
+        '''
+        Calculate the (log base 2) probability of generating every sequence of `seqs`,
+        skipping `masks` (a `MaskIndex` or `None` for every sequence) like `generating_prob`.
+        Characters outside of the vocabulary are skipped.
+        The sequences are not batched: every sequence runs its own forward scan, vectorized over its positions only.
+        '''
+        masks = self._check_batch(seqs, masks)
+        return np.array([ self.generating_prob(seq, mask) for seq, mask in zip(seqs, masks) ])
+
+
+    def state_sequence(self, seq, mask=None):
+        '''
+        Use Viterbi algorithm to calculate the most likely state sequence for emitting the given sequence `seq`.
+        Every unmasked interval of `mask` is decoded on its own, masked positions get `self.masked_state`.
+        '''
+        if not isinstance(seq, str):
+            raise TypeError('Invalid parameter `seq`.')
+
+        log_init, log_trans, log_emission, log_first_choice = self._log_arrays()
+        codes = encode(seq, self.vocab2id)
+        state_chars = np.frombuffer(
+            ''.join(self.id2state[index] for index in range(self.state_num)).encode() + self.masked_state.encode(), dtype=np.uint8
+        )
+        states = np.full(len(seq), self.state_num, dtype=np.uint8)
+        for start, end in self._segments(seq, mask):
+            if end == start:
+                continue
+            log_emit, _, _ = self._log_emissions(codes[start:end], log_emission, log_first_choice)
+            states[start:end] = self._viterbi(log_emit, log_init, log_trans)
+        return list(state_chars[states].tobytes().decode())
+
+
+    def _viterbi(self, log_emit, log_init, log_trans):
+        '''
+        Calculate the most likely state ids of one segment.
+        The best path scores come from a max-plus prefix scan, the backtracking pointers are
+        followed from the end by `_compose_scan`.
+        '''
+        delta = np.empty_like(log_emit)
+        delta[0] = log_init + log_emit[0]
+        _scan_vector(delta[0], log_trans, log_emit[1:], _max_plus, out=delta[1:])
+
+        # `back_pointers[i][state]` is the best state before `state` at position i+1,
+        # calculated in blocks and stored as bytes (there are at most 10 states)
+        back_pointers = np.empty((len(log_emit)-1, self.state_num), dtype=np.uint8)
+        block_size = max(1, _SCAN_CELLS // self.state_num**2)
+        for start in range(0, len(back_pointers), block_size):
+            end = min(start+block_size, len(back_pointers))
+            back_pointers[start:end] = (delta[start:end, :, None] + log_trans[None]).argmax(axis=1)
+        last_state = delta[-1].argmax()
+        states = np.empty(len(log_emit), dtype=np.uint8)
+        states[-1] = last_state
+        states[:-1] = _compose_scan(back_pointers[::-1], last_state)[::-1]
+        return states
+
+
 def test():
     logging.basicConfig(level=logging.INFO,
             format='\n%(asctime)s %(name)-5s === %(levelname)-5s === \n%(message)s\n')
@@ -263,5 +882,31 @@ def test():
     print(f'Target sequence generation probability: {hidden_markov_model.generating_prob(seq)}')
     print(f'The most likely state sequence for emitting the target sequence: {hidden_markov_model.state_sequence(seq)}')
 
+    # test hidden markov model with context-dependent emissions
+    print('\n=== Context Hidden Markov Model ===')
+    context_hidden_markov_model = ContextHiddenMarkovModel(vocab=set(seq), random_seed=17, state_num=2, order=1)
+    context_hidden_markov_model.fit(seq)
+    print(f'Target sequence generation probability: {context_hidden_markov_model.generating_prob(seq)}')
+    print(f'The most likely state sequence for emitting the target sequence: {context_hidden_markov_model.state_sequence(seq)}')
+
+    # the prefix-scan forward and Viterbi match a sequential forward and Viterbi,
+    # on a sequence long enough for several chunks of the scans
+    model = ContextHiddenMarkovModel(vocab=set(seq), random_seed=17, state_num=3, order=2, max_iter=3)
+    model.fit(seq * 20)
+    long_seq = model.generate(5000)
+    log_init, log_trans, log_emission, log_first_choice = model._log_arrays()
+    log_emit, _, _ = model._log_emissions(encode(long_seq, model.vocab2id), log_emission, log_first_choice)
+    forward = log_init + log_emit[0]
+    best = log_init + log_emit[0]
+    for step_log_emit in log_emit[1:]:
+        forward = np.logaddexp2.reduce(forward[:, None] + log_trans, axis=0) + step_log_emit
+        best = np.max(best[:, None] + log_trans, axis=0) + step_log_emit
+    assert np.isclose(model.generating_prob(long_seq), np.logaddexp2.reduce(forward))
+
+    # the decoded path scores the best sequential score
+    states = [ model.state2id[state] for state in model.state_sequence(long_seq) ]
+    path_log_prob = log_init[states[0]] + log_trans[states[:-1], states[1:]].sum() + log_emit[np.arange(len(states)), states].sum()
+    assert np.isclose(path_log_prob, best.max())
+
 if __name__=="__main__":
     test()
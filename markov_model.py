@@ -2,9 +2,86 @@
 # -*- coding: utf-8 -*-
 
 # Import required modules
-import random
+import copy
+import itertools
 import logging
 import math
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+from sequence import DNA_VOCAB, MaskIndex, encode, kmer_counts, kmer_ids, write_chunks
+
+
+# number of variants rescored at a time by `score_variants`
+_VARIANT_CHUNK = 2**18
+
+# number of matrix cells a block of the prefix scans may hold, and steps multiplied sequentially per chunk
+_SCAN_CELLS = 2**22
+_SCAN_CHUNK = 32
+
+
+def _compose_scan(maps, start):
+    '''
+    Follow the state maps `maps` of shape (N, state_num), where `maps[i][s]` is the state following `s`, from the state `start`.
+    `result[i]` is the state reached after applying `maps[0]`, ..., `maps[i]`, in the dtype of `maps`.
+    The maps are composed within chunks of `_SCAN_CHUNK` maps for all chunks at once, the chunk compositions
+    are followed recursively to find the state entering every chunk, and the chunks are finally followed
+    from their entering states, again for all chunks at once.
+    '''
+    map_num, state_num = maps.shape
+    path = np.empty(map_num, dtype=maps.dtype)
+    chunk_num = map_num // _SCAN_CHUNK if map_num >= 2*_SCAN_CHUNK else 0
+
+    if chunk_num > 0:
+        # the maps are gathered from the flat array, `chunk_offsets` point to the first map of every chunk
+        flat_maps = maps[:chunk_num*_SCAN_CHUNK].ravel()
+        chunk_offsets = np.arange(chunk_num) * (_SCAN_CHUNK*state_num)
+        composition = flat_maps[chunk_offsets[:, None] + np.arange(state_num)]
+        for step in range(1, _SCAN_CHUNK):
+            composition = flat_maps[chunk_offsets[:, None] + step*state_num + composition]
+
+        states = np.empty(chunk_num, dtype=maps.dtype)
+        states[0] = start
+        states[1:] = _compose_scan(composition[:-1], start)
+        chunk_path = path[:chunk_num*_SCAN_CHUNK].reshape(chunk_num, _SCAN_CHUNK)
+        for step in range(_SCAN_CHUNK):
+            states = flat_maps[chunk_offsets + step*state_num + states]
+            chunk_path[:, step] = states
+        start = path[chunk_num*_SCAN_CHUNK-1]
+
+    # the maps after the last full chunk are followed one by one
+    state = int(start)
+    for index, state_map in enumerate(maps[chunk_num*_SCAN_CHUNK:].tolist(), start=chunk_num*_SCAN_CHUNK):
+        state = state_map[state]
+        path[index] = state
+    return path
+
+
+def _draw_chain(random_nums, thresholds, context_id, vocab_size, choices=None):
+    '''
+    Draw a block of bases of an order-k Markov chain, one from every uniform number of `random_nums`,
+    continuing from `context_id` (the id of the last k bases).
+    `thresholds[context]` (or `thresholds[i][context]` for every position i) are the cumulative probabilities
+    of the bases in the order `choices[context]` (vocabulary order by default), the first threshold reaching
+    the number is drawn. Every draw is turned into a "next context of each context" map,
+    and the maps are followed from `context_id` by `_compose_scan`.
+    Return the bases, the context id before every base and the context id after the block.
+    '''
+    context_num = thresholds.shape[-2]
+    if choices is None:
+        choices = np.broadcast_to(np.arange(vocab_size), (context_num, vocab_size))
+    # count the thresholds below every number, the last base takes the rest
+    ranks = np.zeros((len(random_nums), context_num), dtype=np.uint8)
+    for rank in range(vocab_size-1):
+        ranks += random_nums[:, None] > thresholds[..., rank]
+
+    # `transitions[context][rank]` is the context following the base of that rank
+    transitions = ((np.arange(context_num)[:, None]*vocab_size + choices) % context_num).astype(np.min_scalar_type(context_num))
+    next_contexts = _compose_scan(np.take(transitions, ranks + np.arange(context_num)*vocab_size), context_id)
+    context_ids = np.concatenate(([context_id], next_contexts[:-1]))
+    bases = choices[context_ids, ranks[np.arange(len(random_nums)), context_ids]]
+    return bases, context_ids, next_contexts[-1]
 
 
 class MarkovBase(object):
@@ -19,8 +96,10 @@ class MarkovBase(object):
 
         self.order = None
 
+        # every model owns its random stream, child streams are spawned from `seed_sequence`
         self.random_seed = random_seed
-        random.seed(self.random_seed)
+        self.seed_sequence = np.random.SeedSequence(self.random_seed)
+        self.rng = np.random.default_rng(self.seed_sequence)
 
         self.vocab = sorted(vocab)
         self.vocab_size = len(self.vocab)
@@ -50,56 +129,447 @@ class MarkovBase(object):
 
         if seq_len < 1:
             raise ValueError('Invalid parameter `seq_len`.')
-        
-        seq = ""
-        for i in range(self.order):
-            seq += self._first_choice()
-        for i in range(seq_len-self.order):
-            next_char = self._next_choice(seq[-self.order:])
-            if next_char == None:
-                return seq
-            else:
-                seq += self._next_choice(seq[-self.order:])
 
-        return seq
+        return self._generate_chunk('', seq_len)
+
+    def _generate_chunk(self, context, chunk_len):
+        '''
+        Generate `chunk_len` characters following `context`, the last `order` characters generated so far.
+        Every character takes one uniform number like `_first_choice` and `_next_choice`, the characters
+        following a full context are drawn in blocks by `_draw_chain`.
+        Stop early if the fitted conditional probability doesn't allow any next character.
+        '''
+        if self.cond_prob == None:
+            raise UnboundLocalError('Model hasn\'t been fitted yet.')
+
+        codes = np.empty(chunk_len, dtype=np.uint8)
+        head = min(max(self.order-len(context), 0), chunk_len)
+        first_threshold = np.array([ (index+1) * (1/self.vocab_size) for index in range(self.vocab_size) ])
+        codes[:head] = np.minimum((self.rng.random(head)[:, None] > first_threshold).sum(axis=1), self.vocab_size-1)
+
+        context_id = 0
+        history = np.concatenate((encode(context, self.vocab2id), codes[:head]))
+        for code in history[max(len(history)-self.order, 0):].tolist():
+            context_id = context_id*self.vocab_size + code
+
+        thresholds, choices, dead = self._choice_tables()
+        block_size = max(1, _SCAN_CELLS // (len(thresholds)*self.vocab_size))
+        for start in range(head, chunk_len, block_size):
+            end = min(start+block_size, chunk_len)
+            bases, context_ids, context_id = _draw_chain(
+                self.rng.random(end-start), thresholds, context_id, self.vocab_size, choices
+            )
+            codes[start:end] = bases
+            stops = np.flatnonzero(dead[context_ids])
+            if len(stops) > 0:
+                codes = codes[:start+stops[0]]
+                break
+
+        vocab_chars = np.frombuffer(''.join(self.vocab).encode('latin-1'), dtype=np.uint8)
+        return vocab_chars[codes].tobytes().decode('latin-1')
+
+    def _choice_tables(self):
+        '''
+        Return the thresholds of `_next_choice` for every context, the order of the characters they follow
+        and whether the context allows any next character.
+        `_next_choice` goes through the characters by increasing probability (in vocabulary order for order 0),
+        the impossible ones get the threshold `-inf` so they are never drawn.
+        '''
+        probs = self._cond_prob_table().reshape(-1, self.vocab_size)
+        choices = np.argsort(probs if self.order > 0 else probs > 0, axis=1, kind='stable')
+        sorted_probs = np.take_along_axis(probs, choices, axis=1)
+        thresholds = np.where(sorted_probs > 0, np.cumsum(sorted_probs, axis=1), -np.inf)
+        return thresholds, choices, probs.sum(axis=1) == 0
+
+    def generate_chunks(self, total_len, chunk_size):
+        '''
+        Generate a sequence of `total_len` characters chunk by chunk, carrying the context between the chunks.
+        Joining the chunks gives the same sequence as `generate(total_len)`.
+        '''
+        if not isinstance(total_len, int):
+            raise TypeError('Invalid parameter `total_len`.')
+
+        if not isinstance(chunk_size, int):
+            raise TypeError('Invalid parameter `chunk_size`.')
+
+        if total_len < 1:
+            raise ValueError('Invalid parameter `total_len`.')
+
+        if chunk_size < 1:
+            raise ValueError('Invalid parameter `chunk_size`.')
+
+        return self._iter_chunks(total_len, chunk_size)
+
+    def _iter_chunks(self, total_len, chunk_size):
+        '''
+        Yield the chunks of `generate_chunks`, the parameters are already validated.
+        '''
+        context = ''
+        for start in range(0, total_len, chunk_size):
+            chunk_len = min(chunk_size, total_len-start)
+            chunk = self._generate_chunk(context, chunk_len)
+            if len(chunk) > 0:
+                yield chunk
+            if len(chunk) < chunk_len:
+                return
+            context = (context + chunk[-self.order:])[-self.order:] if self.order > 0 else ''
+
+    def generate_to_file(self, file_path, total_len, chunk_size=1000000, fmt='fasta', name='generated', line_width=60):
+        '''
+        Generate a sequence of `total_len` characters straight into a `fasta` or `2bit` file.
+        Only one chunk of `chunk_size` characters is held in memory at a time.
+        Return the number of generated characters.
+        '''
+        if fmt == '2bit' and not set(self.vocab) <= set(DNA_VOCAB):
+            raise ValueError(f'The 2bit format requires a vocabulary within {DNA_VOCAB}.')
+
+        return write_chunks(file_path, self.generate_chunks(total_len, chunk_size), total_len,
+                fmt=fmt, name=name, line_width=line_width)
+
+    def generate_batch(self, seq_num, seq_len, workers=1):
+        '''
+        Generate `seq_num` sequences, each one from its own child stream spawned from `self.seed_sequence`.
+        The generated sequences don't depend on the number of `workers`.
+        '''
+        if not isinstance(seq_num, int):
+            raise TypeError('Invalid parameter `seq_num`.')
+
+        if not isinstance(workers, int):
+            raise TypeError('Invalid parameter `workers`.')
+
+        if seq_num < 1:
+            raise ValueError('Invalid parameter `seq_num`.')
+
+        if workers < 1:
+            raise ValueError('Invalid parameter `workers`.')
+
+        child_seeds = self.seed_sequence.spawn(seq_num)
+        if workers == 1:
+            return [_generate_with_seed(self, seed, seq_len) for seed in child_seeds]
+
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            return list(executor.map(
+                _generate_with_seed, [self]*seq_num, child_seeds, [seq_len]*seq_num,
+                chunksize=math.ceil(seq_num/workers)
+            ))
     
+    def _segments(self, seq, mask):
+        '''
+        List the `(start, end)` intervals of `seq` which are not covered by `mask`.
+        '''
+        if mask is None:
+            return [(0, len(seq))]
+
+        if not isinstance(mask, MaskIndex):
+            raise TypeError('Invalid parameter `mask`.')
+
+        if mask.seq_len != len(seq):
+            raise ValueError('Invalid parameter `mask`.')
+
+        return mask.unmasked_intervals()
+
+    def _count_kmers(self, seq, mask, k, strand_symmetric=False):
+        '''
+        Count the k-mers of every unmasked interval of `seq`, so no k-mer crosses a mask boundary.
+        Characters outside of the vocabulary are skipped as well.
+        With `strand_symmetric` the reverse complement strand is counted in the same pass.
+        '''
+        if strand_symmetric and self.vocab != DNA_VOCAB:
+            raise ValueError(f'Strand symmetric counting requires the vocabulary {DNA_VOCAB}.')
+
+        codes = encode(seq, self.vocab2id)
+        counts = np.zeros(self.vocab_size**k, dtype=np.int64)
+        for start, end in self._segments(seq, mask):
+            counts += kmer_counts(codes[start:end], k, self.vocab_size, strand_symmetric=strand_symmetric)
+        return counts
+
+    def _add_counts(self, flat_counts):
+        '''
+        Add flat (order+1)-mer counts, indexed by k-mer id, into the nested `self.counts`.
+        '''
+        kmers = itertools.product(self.vocab, repeat=self.order+1)
+        for kmer, count in zip(kmers, flat_counts.tolist()):
+            node = self.counts
+            for char in kmer[:-1]:
+                node = node[char]
+            node[kmer[-1]] += count
+        return
+
+    def _cond_prob_table(self):
+        '''
+        Convert the nested `self.cond_prob` into a flat array indexed by (order+1)-mer id.
+        '''
+        if self.cond_prob == None:
+            raise UnboundLocalError('Model hasn\'t been fitted yet.')
+
+        table = np.zeros(self.vocab_size**(self.order+1))
+        for index, kmer in enumerate(itertools.product(self.vocab, repeat=self.order+1)):
+            node = self.cond_prob
+            for char in kmer:
+                node = node[char]
+            table[index] = node
+        return table
+
+    def position_log_probs(self, seq, mask=None):
+        '''
+        Calculate the (log base 2) probability of every position of `seq` given its context.
+        The first `order` positions of every unmasked interval use `self.first_choice_prob`.
+        Masked positions and characters outside of the vocabulary are `nan`.
+        '''
+        if not isinstance(seq, str):
+            raise TypeError('Invalid parameter `seq`.')
+
+        log_table, log_first_choice = self._log_tables()
+        codes = encode(seq, self.vocab2id)
+        log_probs = np.full(len(seq), np.nan)
+        for start, end in self._segments(seq, mask):
+            first_end = min(start+self.order, end)
+            log_probs[start:first_end] = log_first_choice[np.minimum(codes[start:first_end], self.vocab_size)]
+            ids, valid = kmer_ids(codes[start:end], self.order+1, self.vocab_size)
+            log_probs[first_end:end] = np.where(valid, log_table[np.where(valid, ids, 0)], np.nan)
+        return log_probs
+
+    def _check_batch(self, seqs, masks):
+        '''
+        Validate the sequences of a batch and their `masks` (a `MaskIndex` or `None` for every sequence, or `None`).
+        Return the list of masks.
+        '''
+        if not isinstance(seqs, (list, tuple)) or not all(isinstance(seq, str) for seq in seqs):
+            raise TypeError('Invalid parameter `seqs`.')
+
+        masks = [None] * len(seqs) if masks is None else masks
+        if len(masks) != len(seqs):
+            raise ValueError('Invalid parameter `masks`.')
+
+        return masks
+
+    def _batch_positions(self, seqs, masks):
+        '''
+        Concatenate the sequences of a batch, `masks` holding a `MaskIndex` or `None` for every sequence.
+        Return the codes of the concatenated sequence, the start and end of every sequence in it,
+        and the unmasked positions with their offsets in their unmasked intervals.
+        '''
+        masks = self._check_batch(seqs, masks)
+        lengths = np.array([ len(seq) for seq in seqs ], dtype=np.int64)
+        ends = np.cumsum(lengths)
+        starts = ends - lengths
+
+        # unmasked intervals of all sequences, offset into the concatenated sequence
+        segments = [
+            (offset+start, offset+end)
+                for seq, mask, offset in zip(seqs, masks, starts.tolist()) for start, end in self._segments(seq, mask)
+        ]
+        segment_starts = np.array([ start for start, _ in segments ], dtype=np.int64)
+        segment_lens = np.array([ end-start for start, end in segments ], dtype=np.int64)
+        segment_offsets = np.arange(segment_lens.sum()) - np.repeat(np.cumsum(segment_lens) - segment_lens, segment_lens)
+        positions = np.repeat(segment_starts, segment_lens) + segment_offsets
+        return encode(''.join(seqs), self.vocab2id), starts, ends, positions, segment_offsets
+
+    def batch_generating_prob(self, seqs, masks=None):
+        '''
+        Calculate the (log base 2) probability of generating every sequence of `seqs` in one vectorized pass.
+        `masks` (a `MaskIndex` or `None` for every sequence) are skipped and restart the context like in `generating_prob`.
+        Characters outside of the vocabulary are skipped, sequences which can't be generated get `-inf`.
+        '''
+        codes, starts, ends, positions, segment_offsets = self._batch_positions(seqs, masks)
+        log_table, log_first_choice = self._log_tables()
+        log_probs = np.full(len(codes), np.nan)
+
+        # k-mers ending at least `order` positions into their interval never cross into the previous one
+        ids, valid = kmer_ids(codes, self.order+1, self.vocab_size)
+        kmer_log_probs = np.full(len(codes), np.nan)
+        kmer_log_probs[self.order:] = np.where(valid, log_table[np.where(valid, ids, 0)], np.nan)
+        first = segment_offsets < self.order
+        log_probs[positions] = np.where(
+            first, log_first_choice[np.minimum(codes[positions], self.vocab_size)], kmer_log_probs[positions]
+        )
+
+        log_prob_sums, _ = sum_log_probs(log_probs, starts, ends)
+        return log_prob_sums
+
+    def score_variants(self, reference, variants, ref_log_probs=None):
+        '''
+        Calculate the change of the (log base 2) probability of `reference` caused by every variant of `variants`,
+        given as parallel sequences `(positions, refs, alts)`: the 0-based position of every variant,
+        the reference allele it replaces (empty for insertions) and its alternative allele (empty for deletions).
+        Only the positions of the alternative allele and the `order` positions following it are rescored,
+        for all variants at once, and compared with the same window of `ref_log_probs`
+        (the `position_log_probs` of `reference`, calculated if not given).
+        Return the changes as an array, `nan` if the window can't be generated before nor after the variant.
+        '''
+        if self.cond_prob == None:
+            raise UnboundLocalError('Model hasn\'t been fitted yet.')
+
+        if not isinstance(reference, str):
+            raise TypeError('Invalid parameter `reference`.')
+
+        if not isinstance(variants, (list, tuple)) or len(variants) != 3:
+            raise TypeError('Invalid parameter `variants`.')
+
+        positions = np.asarray(variants[0], dtype=np.int64)
+        refs = np.asarray(variants[1])
+        alts = np.asarray(variants[2])
+        if refs.dtype.kind not in 'SU' or alts.dtype.kind not in 'SU':
+            refs = np.asarray(variants[1], dtype=str)
+            alts = np.asarray(variants[2], dtype=str)
+        if positions.ndim != 1 or refs.shape != positions.shape or alts.shape != positions.shape:
+            raise ValueError('Invalid parameter `variants`.')
+
+        # the reference alleles must match the reference
+        ref_lens = np.char.str_len(refs).astype(np.int64)
+        if np.any(positions < 0) or np.any(positions + ref_lens > len(reference)):
+            raise ValueError('Invalid parameter `variants`.')
+        ref_chars = np.frombuffer(reference.encode('latin-1'), dtype=np.uint8)
+        allele_chars = np.frombuffer(_join_alleles(refs).encode('latin-1'), dtype=np.uint8)
+        allele_offsets = np.arange(len(allele_chars)) - np.repeat(np.cumsum(ref_lens) - ref_lens, ref_lens)
+        if not np.array_equal(ref_chars[np.repeat(positions, ref_lens) + allele_offsets], allele_chars):
+            raise ValueError('Reference alleles of `variants` don\'t match `reference`.')
+
+        if ref_log_probs is None:
+            ref_log_probs = self.position_log_probs(reference)
+        elif len(ref_log_probs) != len(reference):
+            raise ValueError('Invalid parameter `ref_log_probs`.')
+
+        alt_lens = np.char.str_len(alts).astype(np.int64)
+        alt_ends = np.cumsum(alt_lens)
+        alt_codes = np.minimum(encode(_join_alleles(alts), self.vocab2id), self.vocab_size)
+        max_alt_len = int(alt_lens.max()) if len(alt_lens) > 0 else 0
+
+        # characters outside of the vocabulary become an extra code, padded around the reference
+        # so the windows never leave it, and (order+1)-mers containing it are `nan`
+        k = self.order
+        codes = np.concatenate((
+            np.full(k, self.vocab_size), np.minimum(encode(reference, self.vocab2id), self.vocab_size),
+            np.full(k+max_alt_len, self.vocab_size),
+        )).astype(np.intp)
+        log_table, log_first_choice = self._log_tables()
+        digits = np.arange((self.vocab_size+1)**(k+1))[:, None] // (self.vocab_size+1)**np.arange(k, -1, -1) % (self.vocab_size+1)
+        valid = np.all(digits < self.vocab_size, axis=1)
+        padded_log_table = np.full(len(digits), np.nan)
+        padded_log_table[valid] = log_table[np.dot(digits[valid], self.vocab_size**np.arange(k, -1, -1))]
+
+        deltas = np.empty(len(positions))
+        for start in range(0, len(positions), _VARIANT_CHUNK):
+            chunk = slice(start, start+_VARIANT_CHUNK)
+            # the reference positions of the allele and the `order` positions following it
+            window_lens = np.minimum(ref_lens[chunk] + k, len(reference) - positions[chunk])
+            columns = np.arange(int(window_lens.max()) if len(window_lens) > 0 else 0)[None, :]
+            window_log_probs = ref_log_probs[np.minimum(positions[chunk, None] + columns, max(len(reference)-1, 0))]
+
+            chunk_alt_codes = alt_codes[(alt_ends[start-1] if start > 0 else 0):alt_ends[chunk][-1]]
+            deltas[chunk] = self._alt_log_prob_sums(
+                codes, len(reference), padded_log_table, log_first_choice, positions[chunk], ref_lens[chunk], alt_lens[chunk], chunk_alt_codes
+            ) - _window_log_prob_sums(window_log_probs, columns < window_lens[:, None])
+        return deltas
+
+    def _alt_log_prob_sums(self, codes, ref_len, padded_log_table, log_first_choice, positions, ref_lens, alt_lens, alt_codes):
+        '''
+        Sum the (log base 2) probabilities of the positions of every alternative allele and the `order` positions following it.
+        Every variant becomes a row of `order` reference characters, the alternative allele and `order` reference characters
+        (from the padded `codes` of the reference of length `ref_len`), the rows are scored like `position_log_probs` scores a sequence.
+        '''
+        k = self.order
+        width = 2*k + int(alt_lens.max())
+        columns = np.arange(width)[None, :]
+        positions = positions[:, None]
+        alt_lens = alt_lens[:, None]
+
+        ref_index = positions + columns
+        ref_index[:, k:] += ref_lens[:, None] - alt_lens
+        rows = codes[ref_index]
+        # the alternative alleles fill their columns in the order they were concatenated
+        rows[(columns >= k) & (columns < k+alt_lens)] = alt_codes
+
+        # (order+1)-mer ids of the rescored positions, which follow the first `order` columns
+        ids = rows[:, :width-k]
+        for offset in range(1, k+1):
+            ids = ids*(self.vocab_size+1) + rows[:, offset:offset+width-k]
+        log_probs = padded_log_table[ids]
+
+        # the first `order` positions of the sequence use the first choice probabilities
+        if np.any(positions < k):
+            first = positions + columns[:, k:] - k < k
+            log_probs[first] = log_first_choice[rows[:, k:][first]]
+
+        # rescore up to `order` positions after the allele, within the mutated sequence
+        scored_len = np.minimum(k + alt_lens, ref_len - ref_lens[:, None] + alt_lens - positions)
+        return _window_log_prob_sums(log_probs, columns[:, :width-k] < scored_len)
+
+    def _log_tables(self):
+        '''
+        Return the (log base 2) conditional probability table and first choice probabilities,
+        the latter with an extra `nan` entry for characters outside of the vocabulary.
+        '''
+        with np.errstate(divide='ignore'):
+            log_table = np.log2(self._cond_prob_table())
+            log_first_choice = np.log2([ self.first_choice_prob[char] for char in self.vocab ] + [np.nan])
+        return log_table, log_first_choice
+
     def _first_choice(self):
         '''
         Generate the first character of the sequence.
         The probabilities of deciding which character is going to be generated are equal.
         '''
-        random_num = random.random()
+        random_num = self.rng.random()
         for index in range(self.vocab_size):
             cur_threshold = (index+1) * (1/self.vocab_size)
             if random_num <= cur_threshold:
                 return self.id2vocab[index]
 
 
-class MarkovOrderZero(object):
+def sum_log_probs(log_probs, starts, ends):
+    '''
+    Sum the per-position log probabilities over the intervals `[starts, ends)` with prefix sums.
+    `nan` positions are skipped and intervals containing `-inf` sum to `-inf`.
+    Return the sums and the number of summed positions of every interval.
+    '''
+    scored = ~np.isnan(log_probs)
+    impossible = np.isneginf(log_probs)
+    prefix_log_prob = np.concatenate(([0], np.cumsum(np.where(scored & ~impossible, log_probs, 0))))
+    prefix_scored = np.concatenate(([0], np.cumsum(scored)))
+    prefix_impossible = np.concatenate(([0], np.cumsum(impossible)))
+
+    sums = np.where(
+        prefix_impossible[ends] > prefix_impossible[starts], -np.inf, prefix_log_prob[ends] - prefix_log_prob[starts]
+    )
+    return sums, prefix_scored[ends] - prefix_scored[starts]
+
+
+def _window_log_prob_sums(log_probs, scored):
+    '''
+    Sum every row of `log_probs` over its `scored` columns like `sum_log_probs`:
+    `nan` positions are skipped and rows containing `-inf` sum to `-inf`.
+    '''
+    return np.where(scored & ~np.isnan(log_probs), log_probs, 0).sum(axis=1)
+
+
+def _join_alleles(alleles):
+    '''
+    Concatenate an array of `str` or `bytes` alleles into one string, straight from the buffer of the array.
+    '''
+    alleles = np.ascontiguousarray(alleles)
+    chars = alleles.view(np.uint8 if alleles.dtype.kind == 'S' else np.uint32).ravel()
+    chars = chars[chars != 0]
+    if np.any(chars > 255):
+        raise ValueError('Invalid parameter `variants`.')
+    return chars.astype(np.uint8).tobytes().decode('latin-1')
+
+
+def _generate_with_seed(model, seed_sequence, seq_len):
+    '''
+    Generate a sequence with a copy of `model` drawing from the stream of `seed_sequence`.
+    '''
+    model = copy.copy(model)
+    model.rng = np.random.default_rng(seed_sequence)
+    return model.generate(seq_len)
+
+
+class MarkovOrderZero(MarkovBase):
     def __init__(self, vocab, random_seed):
-        super().__init__()
-        
-        if not isinstance(vocab, list) and not isinstance(vocab, set):
-            raise TypeError('Invalid parameter `vocab`.')
-
-        if not isinstance(random_seed, int):
-            raise TypeError('Invalid parameter `random_seed`.')
+        super().__init__(vocab, random_seed)
 
         self.order = 0
 
-        self.random_seed = random_seed
-        random.seed(self.random_seed)
-
-        self.vocab = sorted(vocab)
-        self.vocab_size = len(self.vocab)
-
-        # construct `vocab2id` & `id2vocab`        
-        self.vocab2id = {}
-        self.id2vocab = {}
-        for index, char in enumerate(self.vocab):
-            self.vocab2id[char] = index
-            self.id2vocab[index] = char
-
         # construct `counts`: the dimension should be 4
         self.counts = {}
         for char in self.vocab:
@@ -109,9 +579,11 @@ class MarkovOrderZero(object):
         return
 
 
-    def fit(self, seq):
+    def fit(self, seq, mask=None, strand_symmetric=False):
         '''
         Calculate subsequence occurrences and convert it into conditional probabilities.
+        The intervals covered by `mask` (a `MaskIndex`) are skipped.
+        With `strand_symmetric` the reverse complement strand is counted as well.
         '''
         if not isinstance(seq, str):
             raise TypeError('Invalid parameter `seq`.')
@@ -119,8 +591,7 @@ class MarkovOrderZero(object):
         if len(seq) < self.order+1:
             raise ValueError('Invalid parameter `seq`.')
 
-        for char in seq:
-            self.counts[char] += 1
+        self._add_counts(self._count_kmers(seq, mask, self.order+1, strand_symmetric))
 
         logging.info(f'Counts: {self.counts}')
         self._adjust_cond_prob()
@@ -144,26 +615,6 @@ class MarkovOrderZero(object):
         return
 
 
-    def generate(self, seq_len):
-        '''
-        Generate a sequence with the fitted conditional probability.
-        '''
-        if not isinstance(seq_len, int):
-            raise TypeError('Invalid parameter `seq_len`.')
-
-        if seq_len < 1:
-            raise ValueError('Invalid parameter `seq_len`.')
-        
-        seq = ""
-        for i in range(seq_len):
-            next_char = self._next_choice()
-            if next_char == None:
-                return seq
-            else:
-                seq += self._next_choice()
-
-        return seq
-
     def _next_choice(self):
         '''
         Generate the next character.
@@ -175,7 +626,7 @@ class MarkovOrderZero(object):
         if sum(prob for char, prob in self.cond_prob.items()) == 0:
             return None
 
-        random_num = random.random()
+        random_num = self.rng.random()
         
         cur_threshold = 0
         for index, (char, prob) in enumerate(self.cond_prob.items()):
@@ -186,9 +637,10 @@ class MarkovOrderZero(object):
 
         return self.cond_prob.items()[-1][1]
 
-    def generating_prob(self, seq):
+    def generating_prob(self, seq, mask=None):
         '''
         Calculate the (log base 2) probabilitiy of generating a given sequence.
+        The intervals covered by `mask` (a `MaskIndex`) are skipped.
         '''
         if self.cond_prob == None:
             raise UnboundLocalError('Model hasn\'t been fitted yet.')
@@ -198,11 +650,12 @@ class MarkovOrderZero(object):
 
         log_base = 2
         prob = 0
-        for index, char in enumerate(seq):
-            if self.cond_prob[char] == 0:
-                return 0
-            else:
-                prob += math.log(self.cond_prob[char], log_base)
+        for start, end in self._segments(seq, mask):
+            for char in seq[start:end]:
+                if self.cond_prob[char] == 0:
+                    return 0
+                else:
+                    prob += math.log(self.cond_prob[char], log_base)
 
         return prob
 
@@ -222,9 +675,11 @@ class MarkovOrderOne(MarkovBase):
 
         return
 
-    def fit(self, seq):
+    def fit(self, seq, mask=None, strand_symmetric=False):
         '''
         Calculate subsequence occurrences and convert it into conditional probabilities.
+        The intervals covered by `mask` (a `MaskIndex`) are skipped.
+        With `strand_symmetric` the reverse complement strand is counted as well.
         '''
         if not isinstance(seq, str):
             raise TypeError('Invalid parameter `seq`.')
@@ -232,12 +687,7 @@ class MarkovOrderOne(MarkovBase):
         if len(seq) < self.order+1:
             raise ValueError('Invalid parameter `seq`.')
 
-        seq_len = len(seq)
-        pair_num = seq_len - self.order
-
-        for index, char in enumerate(seq):
-            if index < pair_num:
-                self.counts[char][seq[index+1]] += 1
+        self._add_counts(self._count_kmers(seq, mask, self.order+1, strand_symmetric))
         
         logging.info(f'Counts: {self.counts}')
         self._adjust_cond_prob()
@@ -249,7 +699,7 @@ class MarkovOrderOne(MarkovBase):
         '''
         Convert the number of counts in `self.cond_prob` into probabilities which should sum to 1.
         '''
-        self.cond_prob = self.counts.copy()
+        self.cond_prob = copy.deepcopy(self.counts)
         for char in self.counts.keys():
             occur_count = 0
             for target in self.counts[char].keys():
@@ -276,7 +726,7 @@ class MarkovOrderOne(MarkovBase):
         if len(cur_seq) < self.order:
             raise ValueError(f'Invalid parameter `cur_seq`: {cur_seq}')
         
-        random_num = random.random()
+        random_num = self.rng.random()
         sorted_choices = {k: v for k, v in sorted(self.cond_prob[cur_seq].items(), key=lambda item: item[1])}
 
         cur_threshold = 0
@@ -291,9 +741,10 @@ class MarkovOrderOne(MarkovBase):
         else:
             return sorted_choices.items()[-1][1]
 
-    def generating_prob(self, seq):
+    def generating_prob(self, seq, mask=None):
         '''
         Calculate the (log base 2) probabilitiy of generating a given sequence.
+        The intervals covered by `mask` (a `MaskIndex`) are skipped, every unmasked interval starts a new context.
         '''
         if self.cond_prob == None:
             raise UnboundLocalError('Model hasn\'t been fitted yet.')
@@ -303,14 +754,16 @@ class MarkovOrderOne(MarkovBase):
 
         log_base = 2
         prob = 0
-        for i in range(self.order):
-            prob += math.log(self.first_choice_prob[seq[i]], log_base)
-
-        for index, char in enumerate(seq[self.order:]):
-            if self.cond_prob[seq[index]][char] == 0:
-                return 0
-            else:
-                prob += math.log(self.cond_prob[seq[index]][char], log_base)
+        for start, end in self._segments(seq, mask):
+            segment = seq[start:end]
+            for i in range(min(self.order, len(segment))):
+                prob += math.log(self.first_choice_prob[segment[i]], log_base)
+
+            for index, char in enumerate(segment[self.order:]):
+                if self.cond_prob[segment[index]][char] == 0:
+                    return 0
+                else:
+                    prob += math.log(self.cond_prob[segment[index]][char], log_base)
 
         return prob
 
@@ -332,9 +785,11 @@ class MarkovOrderTwo(MarkovBase):
 
         return
 
-    def fit(self, seq):
+    def fit(self, seq, mask=None, strand_symmetric=False):
         '''
         Calculate subsequence occurrences and convert it into conditional probabilities.
+        The intervals covered by `mask` (a `MaskIndex`) are skipped.
+        With `strand_symmetric` the reverse complement strand is counted as well.
         '''
         if not isinstance(seq, str):
             raise TypeError('Invalid parameter `seq`.')
@@ -342,12 +797,7 @@ class MarkovOrderTwo(MarkovBase):
         if len(seq) < self.order+1:
             raise ValueError('Invalid parameter `seq`.')
 
-        seq_len = len(seq)
-        pair_num = seq_len - self.order
-
-        for index, char in enumerate(seq):
-            if index < pair_num:
-                self.counts[char][seq[index+1]][seq[index+2]] += 1
+        self._add_counts(self._count_kmers(seq, mask, self.order+1, strand_symmetric))
         
         logging.info(f'Counts: {self.counts}')
         self._adjust_cond_prob()
@@ -358,7 +808,7 @@ class MarkovOrderTwo(MarkovBase):
         '''
         Convert the number of counts in `self.cond_prob` into probabilities which should sum to 1.
         '''
-        self.cond_prob = self.counts.copy()
+        self.cond_prob = copy.deepcopy(self.counts)
         for char_first in self.counts.keys():
             for char_second in self.counts[char_first].keys():
                 occur_count = 0
@@ -386,7 +836,7 @@ class MarkovOrderTwo(MarkovBase):
         if len(cur_seq) < self.order:
             raise ValueError(f'Invalid parameter `cur_seq`: {cur_seq}')
         
-        random_num = random.random()
+        random_num = self.rng.random()
         sorted_choices = {k: v for k, v in sorted(self.cond_prob[cur_seq[0]][cur_seq[1]].items(), key=lambda item: item[1])}
 
         cur_threshold = 0
@@ -401,9 +851,10 @@ class MarkovOrderTwo(MarkovBase):
         else:
             return sorted_choices.items()[-1][1]
         
-    def generating_prob(self, seq):
+    def generating_prob(self, seq, mask=None):
         '''
         Calculate the (log base 2) probabilitiy of generating a given sequence.
+        The intervals covered by `mask` (a `MaskIndex`) are skipped, every unmasked interval starts a new context.
         '''
         if self.cond_prob == None:
             raise UnboundLocalError('Model hasn\'t been fitted yet.')
@@ -413,20 +864,28 @@ class MarkovOrderTwo(MarkovBase):
 
         log_base = 2
         prob = 0
-        for i in range(self.order):
-            prob += math.log(self.first_choice_prob[seq[i]], log_base)
-
-        for index, char in enumerate(seq[self.order:]):
-            if self.cond_prob[seq[index]][seq[index+1]][char] == 0:
-                return 0
-            else:
-                prob += math.log(self.cond_prob[seq[index]][seq[index+1]][char], log_base)
+        for start, end in self._segments(seq, mask):
+            segment = seq[start:end]
+            for i in range(min(self.order, len(segment))):
+                prob += math.log(self.first_choice_prob[segment[i]], log_base)
+
+            for index, char in enumerate(segment[self.order:]):
+                if self.cond_prob[segment[index]][segment[index+1]][char] == 0:
+                    return 0
+                else:
+                    prob += math.log(self.cond_prob[segment[index]][segment[index+1]][char], log_base)
 
         return prob
 
 
 
 def test():
+    import os
+    import struct
+    import tempfile
+
+    from sequence import expand_canonical, read_fasta
+
     logging.basicConfig(level=logging.INFO,
             format='\n%(asctime)s %(name)-5s === %(levelname)-5s === %(message)s\n')
 
@@ -456,6 +915,76 @@ def test():
     generated_seq = markov_model_two.generate(len(seq))
     print(f'Generated sequence: {generated_seq}')
     print(f'Target sequence generation probability: {markov_model_two.generating_prob(seq)}')
+    variants = ([3, 7], ['catg', ''], ['', 'catg'])
+    print(f'Generation probability changes of the variants {variants}: {markov_model_two.score_variants(seq, variants)}')
+
+    # variant scoring matches full rescoring of the mutated sequences: every SNV, 1-2 base deletion and insertion
+    variants = ([], [], [])
+    for position in range(len(seq)+1):
+        alleles = [ (seq[position:position+1], char) for char in sorted(set(seq)) if position < len(seq) ]
+        alleles += [ (seq[position:position+length], '') for length in [1, 2] if position+length <= len(seq) ]
+        alleles += [ ('', 'ca') ]
+        for ref, alt in alleles:
+            variants[0].append(position)
+            variants[1].append(ref)
+            variants[2].append(alt)
+    for markov_model in [markov_model_zero, markov_model_one, markov_model_two]:
+        mutated_seqs = [ seq[:position] + alt + seq[position+len(ref):] for position, ref, alt in zip(*variants) ]
+        full_deltas = markov_model.batch_generating_prob(mutated_seqs) - markov_model.batch_generating_prob([seq])[0]
+        assert np.allclose(markov_model.score_variants(seq, variants), full_deltas, equal_nan=True)
+
+    # the block sampler draws the same sequences as the sequential `_first_choice` and `_next_choice`,
+    # and the generated chunks join into the same sequence
+    for markov_model in [markov_model_zero, markov_model_one, markov_model_two]:
+        markov_model.rng = np.random.default_rng(17)
+        generated_seq = markov_model.generate(1000)
+        markov_model.rng = np.random.default_rng(17)
+        sequential_seq = ''
+        while len(sequential_seq) < 1000:
+            if len(sequential_seq) < markov_model.order:
+                next_char = markov_model._first_choice()
+            elif markov_model.order == 0:
+                next_char = markov_model._next_choice()
+            else:
+                next_char = markov_model._next_choice(sequential_seq[-markov_model.order:])
+            if next_char == None:
+                break
+            sequential_seq += next_char
+        assert generated_seq == sequential_seq
+        markov_model.rng = np.random.default_rng(17)
+        assert ''.join(markov_model.generate_chunks(1000, 64)) == generated_seq
+
+    # canonical k-mer counts expand back to the strand symmetric counts, which count the reverse complement as well
+    codes = encode(seq, {char: index for index, char in enumerate(DNA_VOCAB)})
+    complement = {'a': 't', 'c': 'g', 'g': 'c', 't': 'a'}
+    rc_codes = encode(''.join(complement[char] for char in reversed(seq)), {char: index for index, char in enumerate(DNA_VOCAB)})
+    for k in range(1, 5):
+        strand_counts = kmer_counts(codes, k, 4, strand_symmetric=True)
+        assert np.array_equal(strand_counts, kmer_counts(codes, k, 4) + kmer_counts(rc_codes, k, 4))
+        canonical_counts = kmer_counts(codes, k, 4, strand_symmetric=True, canonical=True)
+        assert np.array_equal(expand_canonical(canonical_counts, k), strand_counts)
+
+    # generated sequences round-trip through the FASTA and 2bit writers
+    with tempfile.TemporaryDirectory() as directory:
+        seq_len = 1001
+        markov_model_one.rng = np.random.default_rng(17)
+        generated_seq = markov_model_one.generate(seq_len)
+        for fmt in ['fasta', '2bit']:
+            file_path = os.path.join(directory, f'generated.{fmt}')
+            markov_model_one.rng = np.random.default_rng(17)
+            assert markov_model_one.generate_to_file(file_path, seq_len, chunk_size=64, fmt=fmt, line_width=50) == seq_len
+            if fmt == 'fasta':
+                assert read_fasta(file_path) == generated_seq
+                continue
+
+            with open(file_path, 'rb') as f:
+                data = f.read()
+            record_offset, = struct.unpack_from('<I', data, 17 + data[16])
+            dna_size, = struct.unpack_from('<I', data, record_offset)
+            packed = np.frombuffer(data, dtype=np.uint8, offset=record_offset+16)
+            two_bit_codes = (packed[:, None] >> np.array([6, 4, 2, 0])) & 3
+            assert dna_size == seq_len
+            assert ''.join(np.array(list('tcag'))[two_bit_codes.ravel()[:dna_size]]) == generated_seq
 
     return
 
@@ -0,0 +1,33 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+# Import required modules
+import pickle
+
+
+def save_model(model, file_path):
+    '''
+    Save a fitted model to `file_path`.
+    '''
+    if model.cond_prob == None:
+        raise UnboundLocalError('Model hasn\'t been fitted yet.')
+
+    with open(file_path, 'wb') as f:
+        pickle.dump(model, f, protocol=pickle.HIGHEST_PROTOCOL)
+    return
+
+
+def load_model(file_path):
+    '''
+    Load a model saved by `save_model`.
+    Only load files from trusted sources, models are stored with pickle.
+    '''
+    from markov_model import MarkovBase
+
+    with open(file_path, 'rb') as f:
+        model = pickle.load(f)
+
+    if not isinstance(model, MarkovBase):
+        raise TypeError(f'{file_path} doesn\'t contain a model.')
+
+    return model
@@ -0,0 +1,286 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+'''
+Cross-validated selection of the Markov model order.
+
+The region is split into K contiguous folds. The k-mer count tensors of every fold are computed once,
+the training counts of a fold are the total counts minus the counts of the held-out fold,
+so no model is ever refitted from the raw sequence.
+With strand symmetric counting the fold tensors can be stored for the canonical k-mers only, halving their memory.
+'''
+
+# Import required modules
+import json
+import logging
+import math
+import timeit
+from argparse import ArgumentParser
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+from sequence import DNA_VOCAB, MaskIndex, encode, expand_canonical, kmer_counts, read_fasta
+
+
+def fold_bounds(seq_len, n_folds):
+    '''
+    Split `seq_len` positions into `n_folds` contiguous folds of (almost) equal size.
+    '''
+    if not isinstance(n_folds, int):
+        raise TypeError('Invalid parameter `n_folds`.')
+
+    if n_folds < 2 or n_folds > seq_len:
+        raise ValueError('Invalid parameter `n_folds`.')
+
+    bounds = np.linspace(0, seq_len, n_folds+1).astype(int)
+    return list(zip(bounds[:-1], bounds[1:]))
+
+
+def count_fold(codes, max_order, vocab_size, strand_symmetric=False, canonical=False):
+    '''
+    Count the (order+1)-mers of one fold for every order in 0..`max_order`.
+    Only the k-mers ending at position `max_order` or later are counted,
+    so every order is trained and scored on exactly the same target bases.
+    Return the counts and the counting time of every order.
+    '''
+    counts = []
+    count_times = []
+    for order in range(max_order+1):
+        start_time = timeit.default_timer()
+        counts.append(kmer_counts(codes[max_order-order:], order+1, vocab_size,
+                strand_symmetric=strand_symmetric, canonical=canonical))
+        count_times.append(timeit.default_timer() - start_time)
+
+    return counts, count_times
+
+
+def evaluate_order(train_counts, test_counts, order, vocab_size, pseudocount, canonical=False,
+        strand_symmetric=False, count_time=0.0):
+    '''
+    Estimate the conditional probabilities of an order-`order` model from `train_counts`
+    and score the held-out `test_counts` with them.
+    `count_time` (the time spent counting the training k-mers) is included in the fit time.
+    Strand symmetric counts hold both strands, so the information criteria use half of them,
+    the likelihood and number of bases of the forward strand.
+    '''
+    start_time = timeit.default_timer()
+    if canonical:
+        train_counts = expand_canonical(train_counts, order+1, vocab_size)
+        test_counts = expand_canonical(test_counts, order+1, vocab_size)
+    train_counts = train_counts.reshape(-1, vocab_size)
+    context_counts = train_counts.sum(axis=1, keepdims=True)
+    log_prob = np.log2(train_counts + pseudocount) - np.log2(context_counts + pseudocount*vocab_size)
+    fit_time = count_time + timeit.default_timer() - start_time
+
+    start_time = timeit.default_timer()
+    test_log_likelihood = float(np.dot(test_counts, log_prob.ravel()))
+    score_time = timeit.default_timer() - start_time
+
+    # maximum likelihood of the training data (natural log) for the information criteria
+    nonzero = train_counts > 0
+    strand_num = 2 if strand_symmetric or canonical else 1
+    train_log_likelihood = float(np.sum(
+        train_counts[nonzero] * np.log((train_counts / np.maximum(context_counts, 1))[nonzero])
+    )) / strand_num
+
+    param_num = vocab_size**order * (vocab_size-1)
+    train_num = int(train_counts.sum()) // strand_num
+    test_num = int(test_counts.sum())
+    return {
+        'test_log_likelihood': test_log_likelihood,
+        'test_bases': test_num,
+        'bits_per_base': test_log_likelihood / test_num if test_num > 0 else float('nan'),
+        'aic': 2*param_num - 2*train_log_likelihood,
+        'bic': param_num*math.log(max(train_num, 1)) - 2*train_log_likelihood,
+        'fit_time': fit_time,
+        'score_time': score_time,
+    }
+
+
+def evaluate_fold(train_counts, test_counts, vocab_size, pseudocount, canonical=False, strand_symmetric=False,
+        count_times=None):
+    '''
+    Evaluate every order on one fold, `count_times` are the counting times of the training k-mers of every order.
+    '''
+    count_times = count_times or [0.0] * len(train_counts)
+    return [
+        evaluate_order(train, test, order, vocab_size, pseudocount, canonical, strand_symmetric, count_time)
+            for order, (train, test, count_time) in enumerate(zip(train_counts, test_counts, count_times))
+    ]
+
+
+def evaluate_hmm_fold(train_seq, train_mask, test_seq, test_mask, random_seed, strand_symmetric=False):
+    '''
+    Fit the two-state `HiddenMarkovModel` on the training folds and score the held-out fold.
+    '''
+    from hidden_markov_model import HiddenMarkovModel
+
+    model = HiddenMarkovModel(vocab=DNA_VOCAB, random_seed=random_seed)
+    start_time = timeit.default_timer()
+    model.fit(train_seq, train_mask, strand_symmetric)
+    fit_time = timeit.default_timer() - start_time
+
+    start_time = timeit.default_timer()
+    test_log_likelihood = model.generating_prob(test_seq, test_mask)
+    score_time = timeit.default_timer() - start_time
+
+    # initial state, state changes and emissions of both states
+    param_num = 1 + 2 + 2*(model.vocab_size-1)
+    train_log_likelihood = model.generating_prob(train_seq, train_mask) * math.log(2)
+    train_num = len(train_seq) - train_mask.masked_len()
+    test_num = len(test_seq) - test_mask.masked_len()
+    return {
+        'test_log_likelihood': test_log_likelihood,
+        'test_bases': test_num,
+        'bits_per_base': test_log_likelihood / test_num if test_num > 0 else float('nan'),
+        'aic': 2*param_num - 2*train_log_likelihood,
+        'bic': param_num*math.log(max(train_num, 1)) - 2*train_log_likelihood,
+        'fit_time': fit_time,
+        'score_time': score_time,
+    }
+
+
+def _summarize(name, order, param_num, fold_results):
+    '''
+    Average the per-fold results of one candidate model.
+    '''
+    summary = {'model': name, 'order': order, 'params': param_num, 'folds': fold_results}
+    for key in ['bits_per_base', 'aic', 'bic', 'fit_time', 'score_time']:
+        values = np.array([result[key] for result in fold_results])
+        summary[key] = float(values.mean())
+        summary[f'{key}_std'] = float(values.std())
+    return summary
+
+
+def cross_validate(seq, max_order, n_folds, workers=None, pseudocount=1.0, hmm=False, soft_mask=False,
+        strand_symmetric=False, canonical=False, random_seed=17):
+    '''
+    Cross-validate the Markov models of order 0..`max_order` (and optionally the HMM) on `seq`.
+    N gaps (and soft-masked repeats if `soft_mask`) are neither trained on nor scored.
+    With `strand_symmetric` both strands are counted, `canonical` stores only the canonical k-mers of every fold.
+    Return the candidates ranked by held-out log-likelihood per base, best first.
+    '''
+    if not isinstance(seq, str):
+        raise TypeError('Invalid parameter `seq`.')
+
+    if not isinstance(max_order, int):
+        raise TypeError('Invalid parameter `max_order`.')
+
+    if max_order < 0:
+        raise ValueError('Invalid parameter `max_order`.')
+
+    mask = MaskIndex.from_sequence(seq, soft_mask=soft_mask)
+    seq = seq.lower()
+    vocab_size = len(DNA_VOCAB)
+    codes = mask.apply(encode(seq, {char: index for index, char in enumerate(DNA_VOCAB)}))
+    bounds = fold_bounds(len(codes), n_folds)
+
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        # count every fold once
+        fold_jobs = [
+            executor.submit(count_fold, codes[start:end], max_order, vocab_size, strand_symmetric, canonical)
+                for start, end in bounds
+        ]
+        fold_counts = []
+        fold_count_times = []
+        for job in fold_jobs:
+            counts, count_times = job.result()
+            fold_counts.append(counts)
+            fold_count_times.append(count_times)
+            logging.info(f'Counted fold {len(fold_counts)}/{n_folds} in {sum(count_times):.3f} sec')
+        total_counts = [sum(counts[order] for counts in fold_counts) for order in range(max_order+1)]
+        total_count_times = np.sum(fold_count_times, axis=0)
+
+        # training counts are the total counts minus the held-out fold,
+        # their fit time includes counting the training folds
+        jobs = []
+        for counts, count_times in zip(fold_counts, fold_count_times):
+            train_counts = [total_counts[order] - counts[order] for order in range(max_order+1)]
+            train_count_times = (total_count_times - np.array(count_times)).tolist()
+            jobs.append(executor.submit(evaluate_fold, train_counts, counts, vocab_size, pseudocount, canonical,
+                    strand_symmetric, train_count_times))
+
+        hmm_jobs = []
+        if hmm:
+            for start, end in bounds:
+                # a masked separator keeps the k-mers from spanning the held-out fold, like the fold counts,
+                # and the same target bases as the Markov models are scored
+                separator = MaskIndex([0], [1], 1)
+                train_mask = mask.slice(0, start).concatenate(separator).concatenate(mask.slice(end, len(seq)))
+                test_mask = mask.slice(min(start+max_order, end), end)
+                hmm_jobs.append(executor.submit(
+                    evaluate_hmm_fold, seq[:start] + 'n' + seq[end:], train_mask, seq[start+max_order:end], test_mask,
+                    random_seed, strand_symmetric
+                ))
+
+        fold_results = [job.result() for job in jobs]
+        hmm_results = [job.result() for job in hmm_jobs]
+
+    candidates = []
+    for order in range(max_order+1):
+        param_num = vocab_size**order * (vocab_size-1)
+        results = [result[order] for result in fold_results]
+        candidates.append(_summarize(f'Markov Model Order {order}', order, param_num, results))
+
+    if hmm:
+        param_num = 1 + 2 + 2*(vocab_size-1)
+        candidates.append(_summarize('Hidden Markov Model', None, param_num, hmm_results))
+
+    return sorted(candidates, key=lambda candidate: candidate['bits_per_base'], reverse=True)
+
+
+def format_table(candidates):
+    '''
+    Format the ranked candidates as a plain-text table.
+    '''
+    lines = [
+        f'{"rank":>4}  {"model":<22}{"params":>8}  {"bits/base":>18}  {"AIC":>14}  {"BIC":>14}  {"fit ms":>8}  {"score ms":>8}'
+    ]
+    for rank, candidate in enumerate(candidates, start=1):
+        bits = f'{candidate["bits_per_base"]:.5f} ± {candidate["bits_per_base_std"]:.5f}'
+        lines.append(
+            f'{rank:>4}  {candidate["model"]:<22}{candidate["params"]:>8}  {bits:>18}  '
+            f'{candidate["aic"]:>14.1f}  {candidate["bic"]:>14.1f}  '
+            f'{candidate["fit_time"]*1000:>8.2f}  {candidate["score_time"]*1000:>8.2f}'
+        )
+    return '\n'.join(lines)
+
+
+def main():
+    parser = ArgumentParser(description='Cross-validated selection of the Markov model order.')
+    parser.add_argument('fasta', help='FASTA file (or plain sequence file) to evaluate on.')
+    parser.add_argument('-r', '--region', help='Region to use, e.g. `NC_000006.12:100001-200000`.')
+    parser.add_argument('-k', '--max-order', help='Highest Markov order to evaluate.', type=int, default=5)
+    parser.add_argument('-f', '--folds', help='Number of cross-validation folds.', type=int, default=5)
+    parser.add_argument('-w', '--workers', help='Number of worker processes.', type=int, default=None)
+    parser.add_argument('--pseudocount', help='Pseudocount added to every k-mer count.', type=float, default=1.0)
+    parser.add_argument('--hmm', help='Also evaluate the hidden Markov model.', action='store_true')
+    parser.add_argument('-s', '--soft-mask', help='Whether to skip soft-masked (lowercase) repeats as well as N gaps.', action='store_true')
+    parser.add_argument('--strand-symmetric', help='Count the k-mers of both strands.', action='store_true')
+    parser.add_argument('--canonical', help='Store only the canonical k-mer counts (implies --strand-symmetric).', action='store_true')
+    parser.add_argument('--json', help='Write the results as JSON to this file (`-` for stdout).')
+    parser.add_argument('-p', '--print-detail', help='Whether to print details.', action='store_true')
+    args = parser.parse_args()
+
+    if args.print_detail:
+        logging.basicConfig(level=logging.INFO,
+                format='\n%(asctime)s %(name)-5s === %(levelname)-5s === %(message)s\n')
+
+    seq = read_fasta(args.fasta, args.region)
+    candidates = cross_validate(seq, args.max_order, args.folds,
+            workers=args.workers, pseudocount=args.pseudocount, hmm=args.hmm, soft_mask=args.soft_mask,
+            strand_symmetric=args.strand_symmetric or args.canonical, canonical=args.canonical)
+
+    print(format_table(candidates))
+
+    if args.json == '-':
+        print(json.dumps(candidates, indent=2))
+    elif args.json is not None:
+        with open(args.json, 'w') as f:
+            json.dump(candidates, f, indent=2)
+
+    return
+
+
+if __name__ == '__main__':
+    main()
@@ -4,6 +4,7 @@ import timeit
 
 from markov_model import MarkovOrderZero, MarkovOrderOne, MarkovOrderTwo
 from hidden_markov_model import HiddenMarkovModel
+from sequence import DNA_VOCAB, MaskIndex, read_fasta
 
 class RecordTime(object):
     def __init__(self):
@@ -22,6 +23,7 @@ class RecordTime(object):
 def main():
     parser = ArgumentParser()
     parser.add_argument('-p', '--print-detail', help='Whether to print details.', action='store_true')
+    parser.add_argument('-s', '--soft-mask', help='Whether to skip soft-masked (lowercase) repeats as well as N gaps.', action='store_true')
     args = parser.parse_args()
 
     timer = RecordTime()
@@ -32,21 +34,20 @@ def main():
 
     # read target sequence
     seq_file_path = "./NC_000006_12_Homo_sapiens_chromosome_6_GRCh38_p13_Primary_Assembly.txt"
-    with open(seq_file_path, 'r') as f:
-        s = f.readline()
-        s = s.strip('\n')
-        s = s.lower()
+    s = read_fasta(seq_file_path)
+    mask = MaskIndex.from_sequence(s, soft_mask=args.soft_mask)
+    s = s.lower()
     
     assert len(s) == 100000
 
     # read test sequence
     test_seq_file_path = "./NC_000006_12_Homo_sapiens_chromosome_6_GRCh38_p13_Primary_Assembly_test.txt"
-    with open(test_seq_file_path, 'r') as f:
-        test_s = f.readline()
-        test_s = test_s.strip('\n')
-        test_s = test_s.lower()
+    test_s = read_fasta(test_seq_file_path)
+    test_mask = MaskIndex.from_sequence(test_s, soft_mask=args.soft_mask)
+    test_s = test_s.lower()
     
     assert len(test_s) == 100000
+    logging.info(f'Masked bases: {mask.masked_len()} (target), {test_mask.masked_len()} (test)')
 
     # run Markov models
     model_infos = {
@@ -63,17 +64,17 @@ def main():
 
     for model_name in model_infos.keys():
         print(f'\n=== {model_name} ===')
-        model = model_infos[model_name]['class'](vocab=set(s), random_seed=17)
+        model = model_infos[model_name]['class'](vocab=DNA_VOCAB, random_seed=17)
         timer.start()
-        model.fit(s)
+        model.fit(s, mask)
         timer.stop()
         fit_time = timer.get_duration()
         timer.start()
-        print(f'Target sequence generation probability:\t{model.generating_prob(s)}')
+        print(f'Target sequence generation probability:\t{model.generating_prob(s, mask)}')
         timer.stop()
         calculate_gp_time = timer.get_duration()
         timer.start()
-        print(f'Another 100k sequence generation probability:\t{model.generating_prob(test_s)}')
+        print(f'Another 100k sequence generation probability:\t{model.generating_prob(test_s, test_mask)}')
         timer.stop()
         calculate_another_gp_time = timer.get_duration()
         print(f'Time - fitting model:\t{fit_time:.3f} sec')
@@ -82,17 +83,17 @@ def main():
 
     # run hidden Markov models
     print(f'\n=== Hidden Markov Model ===')
-    hidden_markov_model = HiddenMarkovModel(vocab=set(s), random_seed=17)
+    hidden_markov_model = HiddenMarkovModel(vocab=DNA_VOCAB, random_seed=17)
     timer.start()
-    hidden_markov_model.fit(s)
+    hidden_markov_model.fit(s, mask)
     timer.stop()
     fit_time = timer.get_duration()
     timer.start()
-    print(f'Target sequence generation probability:\t{hidden_markov_model.generating_prob(s)}')
+    print(f'Target sequence generation probability:\t{hidden_markov_model.generating_prob(s, mask)}')
     timer.stop()
     calculate_gp_time = timer.get_duration()
     timer.start()
-    print(f'Another 100k sequence generation probability:\t{hidden_markov_model.generating_prob(test_s)}')
+    print(f'Another 100k sequence generation probability:\t{hidden_markov_model.generating_prob(test_s, test_mask)}')
     timer.stop()
     calculate_another_gp_time = timer.get_duration()
     print(f'Time - fitting model:\t{fit_time:.3f} sec')
@@ -102,9 +103,9 @@ def main():
     # write state sequences to text files
     logging.info('Writing state sequences to file...')
     with open('./state_seq_s.txt', 'w') as f:
-        f.write(''.join(hidden_markov_model.state_sequence(s)))
+        f.write(''.join(hidden_markov_model.state_sequence(s, mask)))
     with open('./state_seq_test_s.txt', 'w') as f:
-        f.write(''.join(hidden_markov_model.state_sequence(test_s)))
+        f.write(''.join(hidden_markov_model.state_sequence(test_s, test_mask)))
 
     return
 
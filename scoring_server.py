@@ -0,0 +1,477 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+'''
+Local asyncio scoring server.
+
+Saved models are loaded once. Concurrent score and decode requests are queued per model and
+coalesced into micro-batches (up to `max_batch_size` sequences or `max_wait_ms` milliseconds),
+every batch is scored with one call of `batch_generating_prob`. The Markov models and the two-state HMM
+score a batch in one vectorized pass, the context HMM runs one forward scan per sequence.
+
+    POST /score   {"model": "order2", "sequence": "acgt..."} or {"model": ..., "sequences": [...]}
+    POST /decode  {"model": "hmm", "sequence": "acgt..."}
+    GET  /models
+    GET  /metrics
+'''
+
+# Import required modules
+import asyncio
+import functools
+import json
+import logging
+import math
+import multiprocessing
+import os
+import timeit
+from argparse import ArgumentParser
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+from model_io import load_model
+
+
+# models of the worker processes, loaded once by `_init_worker`
+_worker_models = None
+
+
+def _init_worker(model_paths):
+    global _worker_models
+    _worker_models = {name: load_model(path) for name, path in model_paths.items()}
+
+
+def score_batch(model, seqs):
+    '''
+    Score a micro-batch of sequences like `cli.py score`: N gaps and other characters outside of the vocabulary
+    are masked and restart the context. Return a list of (log base 2) probabilities, `None` for impossible sequences.
+    '''
+    from sequence import MaskIndex
+
+    masks = [ MaskIndex.from_sequence(seq, vocab=model.vocab) for seq in seqs ]
+    log_probs = model.batch_generating_prob([ seq.lower() for seq in seqs ], masks).tolist()
+    return [ log_prob if math.isfinite(log_prob) else None for log_prob in log_probs ]
+
+
+def decode_batch(model, seqs):
+    '''
+    Decode a micro-batch of sequences, return a list of state sequences.
+    '''
+    from sequence import MaskIndex
+
+    state_paths = []
+    for seq in seqs:
+        mask = MaskIndex.from_sequence(seq, vocab=model.vocab)
+        state_paths.append(''.join(model.state_sequence(seq.lower(), mask)))
+    return state_paths
+
+
+def check_sequence(seq):
+    '''
+    Return why the models can't read `seq`, or `None` if they can.
+    Characters outside of the vocabulary are masked, but sequences are read as latin-1.
+    '''
+    if not isinstance(seq, str):
+        return 'Sequences must be strings.'
+
+    try:
+        seq.encode('latin-1')
+    except UnicodeEncodeError:
+        return 'Sequences must only contain latin-1 characters.'
+
+    return None
+
+
+def _run_in_worker(kind, model_name, seqs):
+    handler = score_batch if kind == 'score' else decode_batch
+    return handler(_worker_models[model_name], seqs)
+
+
+class Metrics(object):
+    '''
+    Request latencies and batch sizes of the most recent requests.
+    '''
+    def __init__(self, window=10000):
+        super().__init__()
+
+        self.request_count = 0
+        self.error_count = 0
+        self.batch_count = 0
+        self.latencies = deque(maxlen=window)
+        self.batch_sizes = deque(maxlen=window)
+        return
+
+    def summary(self):
+        latencies = np.array(self.latencies) * 1000
+        batch_sizes = np.array(self.batch_sizes)
+        summary = {
+            'requests': self.request_count,
+            'errors': self.error_count,
+            'batches': self.batch_count,
+            'latency_ms': {},
+            'batch_size': {},
+        }
+        if len(latencies) > 0:
+            for percentile in [50, 90, 99]:
+                summary['latency_ms'][f'p{percentile}'] = float(np.percentile(latencies, percentile))
+            summary['latency_ms']['max'] = float(latencies.max())
+        if len(batch_sizes) > 0:
+            sizes, counts = np.unique(batch_sizes, return_counts=True)
+            summary['batch_size'] = {
+                'mean': float(batch_sizes.mean()),
+                'max': int(batch_sizes.max()),
+                'histogram': {str(size): int(count) for size, count in zip(sizes.tolist(), counts.tolist())},
+            }
+        return summary
+
+
+class MicroBatcher(object):
+    '''
+    Queue of single-sequence requests, processed in batches by `process_batch(seqs)` (a coroutine function).
+    '''
+    def __init__(self, process_batch, max_batch_size, max_wait_ms, metrics):
+        super().__init__()
+
+        self.process_batch = process_batch
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000
+        self.metrics = metrics
+        self.queue = asyncio.Queue()
+        self.task = None
+        return
+
+    def start(self):
+        self.task = asyncio.get_running_loop().create_task(self._run())
+
+    async def stop(self):
+        if self.task is not None:
+            self.task.cancel()
+            try:
+                await self.task
+            except asyncio.CancelledError:
+                pass
+
+    async def submit(self, seq):
+        '''
+        Queue one sequence and wait for its result.
+        '''
+        future = asyncio.get_running_loop().create_future()
+        await self.queue.put((seq, future))
+        return await future
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = [await self.queue.get()]
+            deadline = loop.time() + self.max_wait
+            while len(batch) < self.max_batch_size:
+                # take whatever is already queued, then wait until the deadline for more
+                if not self.queue.empty():
+                    batch.append(self.queue.get_nowait())
+                    continue
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(self.queue.get(), timeout))
+                except asyncio.TimeoutError:
+                    break
+
+            self.metrics.batch_count += 1
+            self.metrics.batch_sizes.append(len(batch))
+            try:
+                results = await self.process_batch([ seq for seq, _ in batch ])
+            except Exception as e:
+                if len(batch) == 1:
+                    if not batch[0][1].done():
+                        batch[0][1].set_exception(e)
+                    continue
+                # score every sequence on its own, so only the failing requests get the error
+                await self._run_one_by_one(batch)
+                continue
+            for (_, future), result in zip(batch, results):
+                if not future.done():
+                    future.set_result(result)
+
+    async def _run_one_by_one(self, batch):
+        for seq, future in batch:
+            try:
+                result = (await self.process_batch([seq]))[0]
+            except Exception as e:
+                if not future.done():
+                    future.set_exception(e)
+                continue
+            if not future.done():
+                future.set_result(result)
+
+
+class ScoringServer(object):
+    '''
+    HTTP/1.1 server (TCP or Unix socket) scoring sequences with saved models.
+    '''
+    def __init__(self, model_paths, max_batch_size=64, max_wait_ms=5, workers=0):
+        super().__init__()
+
+        if not isinstance(model_paths, dict) or len(model_paths) == 0:
+            raise TypeError('Invalid parameter `model_paths`.')
+
+        if max_batch_size < 1:
+            raise ValueError('Invalid parameter `max_batch_size`.')
+
+        if max_wait_ms < 0:
+            raise ValueError('Invalid parameter `max_wait_ms`.')
+
+        self.model_paths = model_paths
+        self.models = {name: load_model(path) for name, path in model_paths.items()}
+        self.max_batch_size = max_batch_size
+        self.max_wait_ms = max_wait_ms
+        self.workers = workers
+        self.executor = None
+        self.metrics = Metrics()
+        self.batchers = {}
+        self.server = None
+        return
+
+    async def start(self, host='127.0.0.1', port=8000, unix_socket=None):
+        '''
+        Start serving on `host:port`, or on `unix_socket` if given. Return the `asyncio.Server`.
+        '''
+        if self.workers > 0:
+            # don't fork the running event loop and its threads
+            self.executor = ProcessPoolExecutor(
+                max_workers=self.workers, mp_context=multiprocessing.get_context('spawn'),
+                initializer=_init_worker, initargs=(self.model_paths,)
+            )
+
+        for name, model in self.models.items():
+            kinds = ['score', 'decode'] if hasattr(model, 'state_sequence') else ['score']
+            for kind in kinds:
+                batcher = MicroBatcher(functools.partial(self._process_batch, kind, name),
+                        self.max_batch_size, self.max_wait_ms, self.metrics)
+                batcher.start()
+                self.batchers[(kind, name)] = batcher
+
+        if unix_socket is not None:
+            self.server = await asyncio.start_unix_server(self._handle_connection, path=unix_socket)
+        else:
+            self.server = await asyncio.start_server(self._handle_connection, host=host, port=port)
+        logging.info(f'Serving {list(self.models.keys())} on {unix_socket or f"{host}:{port}"}')
+        return self.server
+
+    async def stop(self):
+        if self.server is not None:
+            self.server.close()
+            await self.server.wait_closed()
+        for batcher in self.batchers.values():
+            await batcher.stop()
+        if self.executor is not None:
+            self.executor.shutdown()
+        return
+
+    async def _process_batch(self, kind, model_name, seqs):
+        loop = asyncio.get_running_loop()
+        if self.executor is not None:
+            return await loop.run_in_executor(self.executor, _run_in_worker, kind, model_name, seqs)
+
+        handler = score_batch if kind == 'score' else decode_batch
+        return await loop.run_in_executor(None, handler, self.models[model_name], seqs)
+
+    async def handle_request(self, method, path, body):
+        '''
+        Dispatch one request, return `(status, response)`.
+        '''
+        if method == 'GET' and path == '/metrics':
+            return 200, self.metrics.summary()
+
+        if method == 'GET' and path == '/models':
+            return 200, {name: type(model).__name__ for name, model in self.models.items()}
+
+        if method != 'POST' or path not in ['/score', '/decode']:
+            return 404, {'error': f'Unknown endpoint {method} {path}'}
+
+        try:
+            request = json.loads(body or b'{}')
+        except ValueError:
+            return 400, {'error': 'Invalid JSON body.'}
+
+        kind = path[1:]
+        if not isinstance(request, dict) or not isinstance(request.get('model'), str):
+            return 400, {'error': 'Missing model name.'}
+
+        if (kind, request['model']) not in self.batchers:
+            return 400, {'error': f'No model `{request["model"]}` for /{kind}.'}
+
+        if 'sequences' in request:
+            seqs = request['sequences']
+        elif 'sequence' in request:
+            seqs = [request['sequence']]
+        else:
+            return 400, {'error': 'Missing `sequence` or `sequences`.'}
+
+        if not isinstance(seqs, list):
+            return 400, {'error': 'Sequences must be strings.'}
+
+        for seq in seqs:
+            error = check_sequence(seq)
+            if error is not None:
+                return 400, {'error': error}
+
+        batcher = self.batchers[(kind, request['model'])]
+        results = await asyncio.gather(*[ batcher.submit(seq) for seq in seqs ])
+        key = 'log2_prob' if kind == 'score' else 'states'
+        if 'sequences' in request:
+            return 200, {key: results}
+        return 200, {key: results[0]}
+
+    async def _handle_connection(self, reader, writer):
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line:
+                    break
+                method, path, version = request_line.decode('latin-1').split()
+                headers = {}
+                while True:
+                    line = await reader.readline()
+                    if line in [b'\r\n', b'\n', b'']:
+                        break
+                    name, _, value = line.decode('latin-1').partition(':')
+                    headers[name.strip().lower()] = value.strip()
+                body = await reader.readexactly(int(headers.get('content-length', 0)))
+
+                start_time = timeit.default_timer()
+                self.metrics.request_count += 1
+                try:
+                    status, response = await self.handle_request(method, path, body)
+                except Exception as e:
+                    logging.exception('Request failed')
+                    status, response = 500, {'error': str(e)}
+                if status != 200:
+                    self.metrics.error_count += 1
+                elif path in ['/score', '/decode']:
+                    self.metrics.latencies.append(timeit.default_timer() - start_time)
+
+                payload = json.dumps(response).encode()
+                keep_alive = headers.get('connection', '').lower() != 'close' and version == 'HTTP/1.1'
+                writer.write(
+                    f'HTTP/1.1 {status} {"OK" if status == 200 else "Error"}\r\n'
+                    f'Content-Type: application/json\r\nContent-Length: {len(payload)}\r\n'
+                    f'Connection: {"keep-alive" if keep_alive else "close"}\r\n\r\n'.encode() + payload
+                )
+                await writer.drain()
+                if not keep_alive:
+                    break
+        except (ValueError, asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+        return
+
+
+async def request(method, path, body=None, host='127.0.0.1', port=8000, unix_socket=None):
+    '''
+    Send one request to a running server, return `(status, response)`.
+    '''
+    if unix_socket is not None:
+        reader, writer = await asyncio.open_unix_connection(unix_socket)
+    else:
+        reader, writer = await asyncio.open_connection(host, port)
+
+    payload = b'' if body is None else json.dumps(body).encode()
+    writer.write(
+        f'{method} {path} HTTP/1.1\r\nHost: {host}\r\nContent-Type: application/json\r\n'
+        f'Content-Length: {len(payload)}\r\nConnection: close\r\n\r\n'.encode() + payload
+    )
+    await writer.drain()
+    response = await reader.read()
+    writer.close()
+
+    head, _, payload = response.partition(b'\r\n\r\n')
+    return int(head.split()[1]), json.loads(payload)
+
+
+def _parse_models(values):
+    '''
+    Parse `name=path` (or just `path`, named after the file) model arguments.
+    '''
+    model_paths = {}
+    for value in values:
+        name, _, path = value.rpartition('=')
+        if not name:
+            name = os.path.splitext(os.path.basename(path))[0]
+        model_paths[name] = path
+    return model_paths
+
+
+async def _serve(args):
+    server = ScoringServer(_parse_models(args.model), max_batch_size=args.max_batch_size,
+            max_wait_ms=args.max_wait_ms, workers=args.workers)
+    asyncio_server = await server.start(host=args.host, port=args.port, unix_socket=args.unix_socket)
+    try:
+        await asyncio_server.serve_forever()
+    finally:
+        await server.stop()
+
+
+def main():
+    parser = ArgumentParser(description='Serve saved models over HTTP with request micro-batching.')
+    parser.add_argument('-m', '--model', help='Saved model as `name=path` (repeatable).', action='append', required=True)
+    parser.add_argument('--host', help='Host to listen on.', default='127.0.0.1')
+    parser.add_argument('--port', help='Port to listen on.', type=int, default=8000)
+    parser.add_argument('--unix-socket', help='Listen on this Unix socket instead of TCP.')
+    parser.add_argument('-b', '--max-batch-size', help='Maximum number of sequences per batch.', type=int, default=64)
+    parser.add_argument('-t', '--max-wait-ms', help='Maximum time to wait for a batch to fill up.', type=float, default=5)
+    parser.add_argument('-w', '--workers', help='Number of worker processes scoring the batches (0: threads of this process).', type=int, default=0)
+    parser.add_argument('-p', '--print-detail', help='Whether to print details.', action='store_true')
+    args = parser.parse_args()
+
+    if args.print_detail:
+        logging.basicConfig(level=logging.INFO,
+                format='\n%(asctime)s %(name)-5s === %(levelname)-5s === %(message)s\n')
+
+    try:
+        asyncio.run(_serve(args))
+    except KeyboardInterrupt:
+        pass
+    return
+
+
+def test():
+    '''
+    Fit a model, serve it on a local port and send concurrent requests to it.
+    '''
+    import tempfile
+
+    from markov_model import MarkovOrderTwo
+    from model_io import save_model
+    from sequence import DNA_VOCAB, MaskIndex
+
+    seq = "atccatgcatgcagatccatgcatgaccatggtcagatcg"
+    model = MarkovOrderTwo(vocab=DNA_VOCAB, random_seed=17)
+    model.fit(seq)
+
+    async def run(model_path):
+        server = ScoringServer({'order2': model_path}, max_batch_size=16, max_wait_ms=2)
+        asyncio_server = await server.start(port=0)
+        port = asyncio_server.sockets[0].getsockname()[1]
+        try:
+            responses = await asyncio.gather(*[
+                request('POST', '/score', {'model': 'order2', 'sequence': seq[index:index+10]}, port=port)
+                    for index in range(20)
+            ])
+            for index, (status, response) in enumerate(responses[:3]):
+                expected = model.generating_prob(seq[index:index+10], MaskIndex.from_sequence(seq[index:index+10]))
+                print(f'{seq[index:index+10]}: {status} {response} (expected {expected})')
+            print(f'Metrics: {(await request("GET", "/metrics", port=port))[1]}')
+        finally:
+            await server.stop()
+
+    with tempfile.TemporaryDirectory() as directory:
+        model_path = os.path.join(directory, 'order2.pkl')
+        save_model(model, model_path)
+        asyncio.run(run(model_path))
+    return
+
+
+if __name__ == '__main__':
+    main()
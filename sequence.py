@@ -0,0 +1,354 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+# Import required modules
+import re
+import struct
+
+import numpy as np
+
+
+# the alphabet every DNA model works on
+DNA_VOCAB = ['a', 'c', 'g', 't']
+
+# code used for characters which are not part of the vocabulary
+INVALID = 255
+
+
+def parse_region(region):
+    '''
+    Parse a samtools-style region (`name`, `name:start-end` or `start-end`, 1-based and inclusive).
+    Return `(name, start, end)` with 0-based half-open coordinates, missing parts are `None`.
+    '''
+    if region is None:
+        return None, None, None
+
+    if not isinstance(region, str):
+        raise TypeError('Invalid parameter `region`.')
+
+    match = re.fullmatch(r'(?:(?P<name>[^:]+):)?(?P<start>[\d,]+)-(?P<end>[\d,]+)', region)
+    if match is None:
+        return region, None, None
+
+    start = int(match.group('start').replace(',', ''))
+    end = int(match.group('end').replace(',', ''))
+    if start < 1 or end < start:
+        raise ValueError(f'Invalid parameter `region`: {region}')
+
+    return match.group('name'), start-1, end
+
+
+def read_fasta(file_path, region=None):
+    '''
+    Read one sequence from a FASTA file, keeping the case of the characters.
+    Files without a `>` header (like the bundled 100k `.txt` files) are read as a single sequence.
+    `region` selects a record and/or an interval of it, e.g. `NC_000006.12:100001-200000`.
+    '''
+    name, start, end = parse_region(region)
+
+    chunks = []
+    selected = False
+    found = False
+    with open(file_path, 'r') as f:
+        for line in f:
+            line = line.strip()
+            if not line:
+                continue
+            if line.startswith('>'):
+                if found:
+                    break
+                record_name = line[1:].split(maxsplit=1)[0] if len(line) > 1 else ''
+                selected = name is None or record_name == name
+                found = selected
+                continue
+            if not found and not chunks and name is None:
+                # header-less file
+                selected = found = True
+            if selected:
+                chunks.append(line)
+
+    if not found:
+        raise ValueError(f'Record `{name}` not found in {file_path}.')
+
+    seq = ''.join(chunks)
+    if start is not None:
+        if end > len(seq):
+            raise ValueError(f'Invalid parameter `region`: {region}')
+        seq = seq[start:end]
+
+    return seq
+
+
+def encode(seq, vocab2id):
+    '''
+    Convert a sequence into an array of vocabulary ids.
+    Characters outside of the vocabulary are encoded as `INVALID`.
+    '''
+    if not isinstance(seq, str):
+        raise TypeError('Invalid parameter `seq`.')
+
+    lookup = np.full(256, INVALID, dtype=np.uint8)
+    for char, index in vocab2id.items():
+        lookup[ord(char)] = index
+
+    return lookup[np.frombuffer(seq.encode('latin-1'), dtype=np.uint8)]
+
+
+def kmer_ids(codes, k, base, reverse_complement=False):
+    '''
+    Calculate the id (`base`-ary number) of every k-mer of the encoded sequence `codes`.
+    Return the ids together with a boolean array telling which k-mers contain no `INVALID` code.
+    With `reverse_complement` the ids of the reverse complement k-mers are calculated in the same pass
+    (the complement of code `c` is `base-1-c`, which holds for the sorted a/c/g/t encoding) and returned last.
+    '''
+    kmer_num = len(codes) - k + 1
+    if kmer_num <= 0:
+        empty = np.zeros(0, dtype=np.int64)
+        return (empty, np.zeros(0, dtype=bool), empty) if reverse_complement else (empty, np.zeros(0, dtype=bool))
+
+    ids = np.zeros(kmer_num, dtype=np.int64)
+    valid = np.ones(kmer_num, dtype=bool)
+    if reverse_complement:
+        # sum of the complemented digits with reversed weights, i.e. (base**k-1) - sum(code * base**offset)
+        rc_ids = np.full(kmer_num, base**k - 1, dtype=np.int64)
+    for offset in range(k):
+        window = codes[offset:offset+kmer_num]
+        ids *= base
+        ids += window
+        valid &= window != INVALID
+        if reverse_complement:
+            rc_ids -= window.astype(np.int64) * base**offset
+
+    if reverse_complement:
+        return ids, valid, rc_ids
+    return ids, valid
+
+
+def reverse_complement_ids(ids, k, base=4):
+    '''
+    Calculate the ids of the reverse complements of the k-mers `ids` by reversing their complemented digits.
+    '''
+    ids = np.asarray(ids, dtype=np.int64)
+    rc_ids = np.zeros_like(ids)
+    for _ in range(k):
+        rc_ids = rc_ids*base + (base-1 - ids % base)
+        ids = ids // base
+    return rc_ids
+
+
+def canonical_kmers(k, base=4):
+    '''
+    List the ids of the canonical k-mers, i.e. the k-mers whose id is not larger than the one of their reverse complement.
+    '''
+    ids = np.arange(base**k, dtype=np.int64)
+    return ids[ids <= reverse_complement_ids(ids, k, base)]
+
+
+def expand_canonical(canonical_counts, k, base=4):
+    '''
+    Expand counts of the canonical k-mers (see `canonical_kmers`) into the flat array of all `base**k` k-mers.
+    '''
+    ids = np.arange(base**k, dtype=np.int64)
+    canonical_ids = np.minimum(ids, reverse_complement_ids(ids, k, base))
+    return canonical_counts[np.searchsorted(canonical_kmers(k, base), canonical_ids)]
+
+
+def kmer_counts(codes, k, base, strand_symmetric=False, canonical=False):
+    '''
+    Count the occurrences of every valid k-mer of the encoded sequence `codes`.
+    The result is a flat array of length `base**k` indexed by k-mer id.
+    With `strand_symmetric` the k-mers of the reverse complement strand are counted as well, in the same pass.
+    With `canonical` (strand symmetric counts only) just the counts of `canonical_kmers(k)` are returned,
+    the full table can be rebuilt with `expand_canonical`.
+    '''
+    if canonical and not strand_symmetric:
+        raise ValueError('Canonical counts require `strand_symmetric`.')
+
+    if not strand_symmetric:
+        ids, valid = kmer_ids(codes, k, base)
+        return np.bincount(ids[valid], minlength=base**k)
+
+    ids, valid, rc_ids = kmer_ids(codes, k, base, reverse_complement=True)
+    ids, rc_ids = ids[valid], rc_ids[valid]
+    if not canonical:
+        return np.bincount(ids, minlength=base**k) + np.bincount(rc_ids, minlength=base**k)
+
+    # every occurrence counts once for its canonical k-mer, palindromes are seen on both strands
+    counts = np.bincount(np.minimum(ids, rc_ids), minlength=base**k)
+    canonical_ids = canonical_kmers(k, base)
+    palindromes = canonical_ids == reverse_complement_ids(canonical_ids, k, base)
+    return counts[canonical_ids] * np.where(palindromes, 2, 1)
+
+
+class MaskIndex(object):
+    '''
+    Run-length index of the masked intervals of a sequence: gaps (`N` runs and any other character
+    outside of the vocabulary, e.g. IUPAC ambiguity codes) and optionally soft-masked (lowercase) repeats.
+    Intervals are 0-based and half-open.
+    '''
+    def __init__(self, starts, ends, seq_len):
+        super().__init__()
+
+        self.starts = np.asarray(starts, dtype=np.int64)
+        self.ends = np.asarray(ends, dtype=np.int64)
+        self.seq_len = seq_len
+        return
+
+    @classmethod
+    def from_sequence(cls, seq, soft_mask=False, vocab=DNA_VOCAB):
+        '''
+        Build the index from the original (not lowercased) sequence.
+        Characters outside of `vocab` (in either case) are masked.
+        '''
+        if not isinstance(seq, str):
+            raise TypeError('Invalid parameter `seq`.')
+
+        vocab2id = {char: index for index, char in enumerate(vocab)}
+        vocab2id.update({char.upper(): index for index, char in enumerate(vocab)})
+        masked = encode(seq, vocab2id) == INVALID
+        chars = np.frombuffer(seq.encode('latin-1'), dtype=np.uint8)
+        if soft_mask:
+            masked |= (chars >= ord('a')) & (chars <= ord('z'))
+
+        edges = np.diff(np.concatenate(([0], masked.view(np.int8), [0])))
+        return cls(np.flatnonzero(edges == 1), np.flatnonzero(edges == -1), len(seq))
+
+    def __len__(self):
+        return len(self.starts)
+
+    def masked_len(self):
+        '''
+        Total number of masked positions.
+        '''
+        return int(np.sum(self.ends - self.starts))
+
+    def intervals(self):
+        '''
+        List the masked intervals as `(start, end)` pairs.
+        '''
+        return list(zip(self.starts.tolist(), self.ends.tolist()))
+
+    def unmasked_intervals(self):
+        '''
+        List the intervals between the masked ones as `(start, end)` pairs, empty ones are skipped.
+        '''
+        starts = np.concatenate(([0], self.ends))
+        ends = np.concatenate((self.starts, [self.seq_len]))
+        keep = ends > starts
+        return list(zip(starts[keep].tolist(), ends[keep].tolist()))
+
+    def slice(self, start, end):
+        '''
+        Return the index of the subsequence `[start, end)`.
+        '''
+        keep = (self.ends > start) & (self.starts < end)
+        starts = np.maximum(self.starts[keep], start) - start
+        ends = np.minimum(self.ends[keep], end) - start
+        return MaskIndex(starts, ends, end-start)
+
+    def concatenate(self, other):
+        '''
+        Return the index of this sequence followed by the sequence of `other`.
+        '''
+        return MaskIndex(
+            np.concatenate((self.starts, other.starts + self.seq_len)),
+            np.concatenate((self.ends, other.ends + self.seq_len)),
+            self.seq_len + other.seq_len,
+        )
+
+    def apply(self, codes):
+        '''
+        Set the codes of all masked positions to `INVALID`, in place.
+        '''
+        for start, end in self.intervals():
+            codes[start:end] = INVALID
+        return codes
+
+
+# 2bit packing of the bases: T=0, C=1, A=2, G=3
+_TWO_BIT_CODES = {'t': 0, 'c': 1, 'a': 2, 'g': 3}
+_TWO_BIT_SIGNATURE = 0x1A412743
+
+
+def _write_fasta(f, chunks, name, line_width):
+    '''
+    Write the chunks as one FASTA record with fixed-width lines, return the number of written characters.
+    '''
+    f.write(f'>{name}\n')
+    seq_len = 0
+    rest = ''
+    for chunk in chunks:
+        seq_len += len(chunk)
+        rest += chunk
+        line_end = len(rest) - len(rest) % line_width
+        f.write(''.join(rest[start:start+line_width] + '\n' for start in range(0, line_end, line_width)))
+        rest = rest[line_end:]
+    if rest:
+        f.write(rest + '\n')
+    return seq_len
+
+
+def _write_two_bit(f, chunks, total_len, name):
+    '''
+    Write the chunks as a single-sequence UCSC 2bit file, return the number of written bases.
+    The header is written upfront with `total_len` and patched if fewer bases were generated.
+    '''
+    name = name.encode()
+    record_offset = 16 + 1 + len(name) + 4
+    f.write(struct.pack('<4I', _TWO_BIT_SIGNATURE, 0, 1, 0))
+    f.write(struct.pack('<B', len(name)) + name + struct.pack('<I', record_offset))
+    # DNA size, no N blocks, no mask blocks, reserved
+    f.write(struct.pack('<4I', total_len, 0, 0, 0))
+
+    lookup = np.full(256, INVALID, dtype=np.uint8)
+    for char, code in _TWO_BIT_CODES.items():
+        lookup[ord(char)] = lookup[ord(char.upper())] = code
+
+    seq_len = 0
+    rest = np.zeros(0, dtype=np.uint8)
+    for chunk in chunks:
+        seq_len += len(chunk)
+        codes = np.concatenate((rest, lookup[np.frombuffer(chunk.encode('latin-1'), dtype=np.uint8)]))
+        if np.any(codes == INVALID):
+            raise ValueError('The 2bit format can only store a/c/g/t.')
+        packed_len = len(codes) - len(codes) % 4
+        f.write(_pack_two_bit(codes[:packed_len]))
+        rest = codes[packed_len:]
+    if len(rest) > 0:
+        f.write(_pack_two_bit(np.concatenate((rest, np.zeros(4-len(rest), dtype=np.uint8)))))
+
+    if seq_len != total_len:
+        f.seek(record_offset)
+        f.write(struct.pack('<I', seq_len))
+    return seq_len
+
+
+def _pack_two_bit(codes):
+    '''
+    Pack 2bit codes (length divisible by 4) into bytes, the first base in the most significant bits.
+    '''
+    codes = codes.reshape(-1, 4)
+    return (codes[:, 0] << 6 | codes[:, 1] << 4 | codes[:, 2] << 2 | codes[:, 3]).astype(np.uint8).tobytes()
+
+
+def write_chunks(file_path, chunks, total_len, fmt='fasta', name='generated', line_width=60):
+    '''
+    Write a sequence given as an iterable of string chunks to `file_path` incrementally,
+    as FASTA (`fmt='fasta'`, lines of `line_width` characters) or as UCSC 2bit (`fmt='2bit'`).
+    Return the number of written characters.
+    '''
+    if fmt not in ['fasta', '2bit']:
+        raise ValueError(f'Invalid parameter `fmt`: {fmt}')
+
+    if not isinstance(line_width, int):
+        raise TypeError('Invalid parameter `line_width`.')
+
+    if line_width < 1:
+        raise ValueError('Invalid parameter `line_width`.')
+
+    if fmt == 'fasta':
+        with open(file_path, 'w') as f:
+            return _write_fasta(f, chunks, name, line_width)
+
+    with open(file_path, 'wb') as f:
+        return _write_two_bit(f, chunks, total_len, name)